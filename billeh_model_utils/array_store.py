@@ -0,0 +1,64 @@
+import hashlib
+import os
+import pickle as pkl
+
+import numpy as np
+
+
+def hash_arrays(*arrays):
+    # Fingerprint of the shapes, dtypes and contents of the arrays
+    h = hashlib.sha1()
+    for a in arrays:
+        a = np.ascontiguousarray(a)
+        h.update(f'{a.shape}{a.dtype}'.encode())
+        h.update(a.tobytes())
+    return h.hexdigest()
+
+
+class _StoredArray:
+    # Placeholder of a stored array in the pickled structure, replaced by the memory map on load
+    def __init__(self, file_name):
+        self.file_name = file_name
+
+
+def _store(value, directory, prefix, min_size):
+    if isinstance(value, dict):
+        return {k: _store(v, directory, f'{prefix}.{k}', min_size) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return type(value)(_store(v, directory, f'{prefix}.{i}', min_size) for i, v in enumerate(value))
+    if isinstance(value, np.ndarray) and value.dtype != object and value.nbytes >= min_size:
+        file_name = f'{prefix}.npy'
+        np.save(os.path.join(directory, file_name), value)
+        return _StoredArray(file_name)
+    return value
+
+
+def _open(value, directory, mmap_mode):
+    if isinstance(value, dict):
+        return {k: _open(v, directory, mmap_mode) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return type(value)(_open(v, directory, mmap_mode) for v in value)
+    if isinstance(value, _StoredArray):
+        return np.load(os.path.join(directory, value.file_name), mmap_mode=mmap_mode)
+    return value
+
+
+def save_arrays(data, directory, min_size=2 ** 16):
+    # Write the arrays of a nested structure of dicts, lists and tuples (e.g. the (input_population,
+    # network, bkg, bkg_weights) tuple of cached_load_billeh) of at least min_size bytes as .npy files of
+    # directory, and the rest of the structure as a small pickle. Returns the directory
+    os.makedirs(directory, exist_ok=True)
+    structure = _store(data, directory, 'array', min_size)
+    with open(os.path.join(directory, 'structure.pkl'), 'wb') as f:
+        pkl.dump(structure, f)
+    return directory
+
+
+def load_arrays(directory, mmap_mode='c'):
+    # Zero-copy view of a structure written with save_arrays. Every call returns new dicts, so the
+    # in-place changes a caller makes to them do not leak to other calls. With the default
+    # copy-on-write mode all the processes read the same pages of the page cache, and a process that
+    # writes into an array only copies the pages it modifies, without touching the file
+    with open(os.path.join(directory, 'structure.pkl'), 'rb') as f:
+        structure = pkl.load(f)
+    return _open(structure, directory, mmap_mode)
@@ -0,0 +1,305 @@
+import argparse
+import itertools
+import json
+import multiprocessing as mp
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import tensorflow as tf
+
+import instrumentation
+import load_sparse
+import models
+import synthetic_network
+
+
+def _time_function(fn, *args, n_repeats=5):
+    # The first call traces the tf.function, so it is excluded from the timing
+    tf.nest.map_structure(lambda _a: _a.numpy(), fn(*args))
+    t0 = time.time()
+    for _ in range(n_repeats):
+        result = fn(*args)
+        tf.nest.map_structure(lambda _a: _a.numpy(), result)
+    return (time.time() - t0) / n_repeats, result
+
+
+def benchmark_exp_convolve(seq_lens=(250, 1000, 2500, 10000), n_neurons=1000, batch_size=1,
+                           decay=.8, chunk_size=128, rate=.02, seed=3000, n_repeats=5):
+    # Compare the sequential tf.scan implementation of exp_convolve with the parallel prefix one
+    rd = np.random.RandomState(seed=seed)
+    scan_fn = tf.function(lambda x: models.exp_convolve(x, decay=decay, axis=1))
+    parallel_fn = tf.function(lambda x: models.parallel_exp_convolve(
+        x, decay=decay, axis=1, chunk_size=chunk_size))
+    results = []
+    for seq_len in seq_lens:
+        spikes = tf.constant(
+            (rd.uniform(size=(batch_size, seq_len, n_neurons)) < rate).astype(np.float32))
+        scan_time, scan_result = _time_function(scan_fn, spikes, n_repeats=n_repeats)
+        parallel_time, parallel_result = _time_function(parallel_fn, spikes, n_repeats=n_repeats)
+        max_error = np.max(np.abs(scan_result.numpy() - parallel_result.numpy()))
+        results.append(dict(seq_len=seq_len, scan_time=scan_time, parallel_time=parallel_time,
+                            speedup=scan_time / parallel_time, max_error=max_error))
+        print(f'> seq_len {seq_len}: tf.scan {scan_time * 1000:.1f} ms, '
+              f'parallel {parallel_time * 1000:.1f} ms, max error {max_error:.2e}')
+    return results
+
+
+def benchmark_rate_distribution_loss(n_neurons_list=(10000, 50000, 230924), seq_len=100, batch_size=1,
+                                     n_bins=1000, seed=3000, n_repeats=5):
+    # Speed of the sort and histogram modes of SpikeRateDistributionRegularization and how far apart their
+    # losses are (the histogram mode only matches the sort mode in expectation).
+    # The neurons get lognormal rates, and the targets are sampled from the same distribution
+    rd = np.random.RandomState(seed=seed)
+    results = []
+    for n_neurons in n_neurons_list:
+        rates = np.minimum(rd.lognormal(np.log(.005), 1., size=n_neurons), .5)
+        spikes = tf.constant(
+            (rd.uniform(size=(batch_size, seq_len, n_neurons)) < rates).astype(np.float32))
+        target_rates = np.sort(np.minimum(rd.lognormal(np.log(.005), 1., size=n_neurons), .5))
+        target_rates = tf.constant(target_rates.astype(np.float32))
+        sort_reg = models.SpikeRateDistributionRegularization(target_rates, mode='sort')
+        histogram_reg = models.SpikeRateDistributionRegularization(
+            target_rates, mode='histogram', n_bins=n_bins)
+
+        def _loss_and_grad(reg):
+            @tf.function
+            def fn(spikes_batch):
+                with tf.GradientTape() as tape:
+                    tape.watch(spikes_batch)
+                    loss = reg(spikes_batch)
+                return loss, tape.gradient(loss, spikes_batch)
+            return fn
+
+        sort_time, (sort_loss, _) = _time_function(_loss_and_grad(sort_reg), spikes, n_repeats=n_repeats)
+        histogram_time, (histogram_loss, _) = _time_function(
+            _loss_and_grad(histogram_reg), spikes, n_repeats=n_repeats)
+        relative_error = abs(float(histogram_loss) - float(sort_loss)) / float(sort_loss)
+        results.append(dict(n_neurons=n_neurons, sort_time=sort_time, histogram_time=histogram_time,
+                            sort_loss=float(sort_loss), histogram_loss=float(histogram_loss),
+                            relative_error=relative_error))
+        print(f'> {n_neurons} neurons: sort {sort_time * 1000:.1f} ms, histogram {histogram_time * 1000:.1f} ms, '
+              f'loss {float(sort_loss):.4e} vs {float(histogram_loss):.4e} ({relative_error:.2%})')
+    return results
+
+
+def benchmark_neuron_reordering(network, input_population, bkg_weights, methods=(None, 'type', 'type_space', 'rcm'),
+                                batch_size=1, max_delay=5, rate=.02, seed=3000, n_repeats=20):
+    # Time of the recurrent sparse matmul of BillehColumn for several neuron orderings (None keeps the loaded one).
+    # The mean distance between the target and the source of the synapses is reported as a proxy of locality
+    rd = np.random.RandomState(seed=seed)
+    n_nodes = network['n_nodes']
+    n_receptors = network['synapses']['dense_shape'][0] // n_nodes
+    results = []
+    for method in methods:
+        if method is None:
+            _network, _input_population, _bkg_weights = network, input_population, bkg_weights
+        else:
+            _network, _input_population, _bkg_weights = load_sparse.reorder_network(
+                network, input_population, bkg_weights, method=method)
+        indices = _network['synapses']['indices']
+        bandwidth = np.mean(np.abs(indices[:, 0] // n_receptors - indices[:, 1]))
+        cell = models.BillehColumn(_network, _input_population, _bkg_weights, max_delay=max_delay)
+        z_buf = tf.constant((rd.uniform(size=(batch_size, cell.state_size[0])) < rate).astype(np.float32))
+        matmul_time, _ = _time_function(tf.function(cell._recurrent_current), z_buf, n_repeats=n_repeats)
+        results.append(dict(method=method, matmul_time=matmul_time, bandwidth=bandwidth))
+        print(f'> ordering {method}: {matmul_time * 1000:.2f} ms per step, mean |target - source| {bandwidth:.0f}')
+    return results
+
+
+def _simulate(network, input_population, bkg_weights, lgn_input, seed=3000, **cell_kwargs):
+    # Spikes of the network for lgn_input (batch, seq_len, n_inputs) and the wall time of the simulation
+    tf.random.set_seed(seed)
+    cell = models.BillehColumn(network, input_population, bkg_weights, **cell_kwargs)
+    input_layer = models.SparseLayer(
+        cell.input_indices, cell.input_weight_values, cell.input_dense_shape, cell.bkg_weights)
+    rnn = models.ColumnRNN(cell, return_sequences=True)
+
+    @tf.function
+    def run(x):
+        return rnn(input_layer(x), initial_state=cell.zero_state(x.shape[0]))[0]
+
+    x = tf.constant(lgn_input, tf.float32)
+    run(x)
+    t0 = time.time()
+    tf.random.set_seed(seed)
+    spikes = run(x).numpy()
+    return spikes, time.time() - t0
+
+
+def benchmark_per_type_params(network, input_population, bkg_weights, lgn_input, seed=3000, **cell_kwargs):
+    # Simulation time and bytes of the stored neuron parameters of BillehColumn with per neuron and with
+    # per type parameters. The neurons are first sorted by type, so that both modes run on the same network
+    network, input_population, bkg_weights = load_sparse.sort_neurons_by_type(
+        network, input_population, bkg_weights)
+    results = []
+    for per_type_params in (False, True):
+        cell = models.BillehColumn(network, input_population, bkg_weights, per_type_params=per_type_params,
+                                   **cell_kwargs)
+        param_bytes = sum(v.shape.num_elements() * v.dtype.size for v in [
+            cell.v_reset, cell.syn_decay, cell.psc_initial, cell.t_ref, cell.asc_amps, cell.param_k, cell.v_th,
+            cell.e_l, cell.param_g, cell.decay, cell.current_factor, cell.voltage_scale, cell.voltage_offset])
+        spikes, elapsed = _simulate(network, input_population, bkg_weights, lgn_input, seed=seed,
+                                    per_type_params=per_type_params, **cell_kwargs)
+        results.append(dict(per_type_params=per_type_params, time=elapsed, param_bytes=param_bytes,
+                            mean_rate=spikes.mean() * 1000))
+        print(f'> per_type_params={per_type_params}: {elapsed:.2f} s, {param_bytes / 1e6:.2f} MB of neuron '
+              f'parameters, mean rate {results[-1]["mean_rate"]:.2f} Hz')
+    return results
+
+
+def compare_pruned_firing_rates(network, input_population, bkg_weights, lgn_input, abs_threshold=None,
+                                rel_threshold=None, seed=3000, **cell_kwargs):
+    # Firing rates and simulation time of the pruned network against the unpruned one, with the same input
+    pruned_network, pruned_input_population, report = load_sparse.prune_network(
+        network, input_population, bkg_weights, abs_threshold=abs_threshold, rel_threshold=rel_threshold)
+    spikes, elapsed = _simulate(network, input_population, bkg_weights, lgn_input, seed=seed, **cell_kwargs)
+    pruned_spikes, pruned_elapsed = _simulate(
+        pruned_network, pruned_input_population, bkg_weights, lgn_input, seed=seed, **cell_kwargs)
+    # rates in Hz (dt = 1 ms)
+    rates = spikes.mean((0, 1)) * 1000
+    pruned_rates = pruned_spikes.mean((0, 1)) * 1000
+    result = dict(report=report, mean_rate=rates.mean(), pruned_mean_rate=pruned_rates.mean(),
+                  max_rate_change=np.max(np.abs(pruned_rates - rates)),
+                  rate_correlation=np.corrcoef(rates, pruned_rates)[0, 1],
+                  time=elapsed, pruned_time=pruned_elapsed)
+    print(f'> Mean rate {result["mean_rate"]:.2f} Hz -> {result["pruned_mean_rate"]:.2f} Hz, '
+          f'per neuron correlation {result["rate_correlation"]:.3f}, time {elapsed:.2f} s -> {pruned_elapsed:.2f} s')
+    return result
+
+
+def scaling_case(n_neurons, batch_size, seq_len, max_delay, dtype, connection_probability, mode,
+                  n_input=1000, n_repeats=3, seed=3000):
+    # Throughput of create_model on a synthetic network, either for inference (a forward pass)
+    # or for a training step (forward, backward and Adam update)
+    tf.random.set_seed(seed)
+    # the cell computes in the dtype of the keras policy, so reduced precision needs a mixed policy
+    tf.keras.mixed_precision.set_global_policy('float32' if dtype == 'float32' else f'mixed_{dtype}')
+    input_population, network, _, bkg_weights = synthetic_network.make_synthetic_billeh(
+        n_neurons=n_neurons, n_input=n_input, connection_probability=connection_probability, seed=seed)
+    model = models.create_model(network, input_population, bkg_weights, seq_len=seq_len, n_input=n_input,
+                                dtype=tf.as_dtype(dtype), max_delay=max_delay, batch_size=batch_size,
+                                add_metric=False)
+    rd = np.random.RandomState(seed=seed)
+    x = tf.constant((rd.uniform(size=(batch_size, seq_len, n_input)) < .02).astype(np.float32))
+    state_input = tf.zeros((batch_size, seq_len, n_neurons))
+    labels = tf.zeros((batch_size,), tf.int32)
+
+    if mode == 'inference':
+        @tf.function
+        def step():
+            return model((x, state_input), training=False)
+    else:
+        optimizer = tf.keras.optimizers.Adam(1e-3)
+
+        @tf.function
+        def step():
+            with tf.GradientTape() as tape:
+                prediction = model((x, state_input), training=True)
+                loss = tf.reduce_mean(tf.keras.losses.sparse_categorical_crossentropy(labels, prediction))
+                if model.losses:
+                    loss += tf.add_n(model.losses)
+            grads = tape.gradient(loss, model.trainable_variables)
+            optimizer.apply_gradients(zip(grads, model.trainable_variables))
+            return loss
+
+    t0 = time.time()
+    step().numpy()
+    first_call_time = time.time() - t0
+    step_time, _ = _time_function(step, n_repeats=n_repeats)
+    tf.keras.mixed_precision.set_global_policy('float32')
+    return dict(steps_per_s=seq_len / step_time,
+                ms_per_simulated_s=step_time * 1000 / (seq_len / 1000),
+                step_time=step_time, trace_time=max(first_call_time - step_time, 0.),
+                n_synapses=int(network['n_edges']), peak_rss_mb=instrumentation.peak_rss_mb())
+
+
+def run_isolated(fn, **kwargs):
+    # Every case runs in a fresh process, so that its peak RSS and traces do not include the previous cases
+    with ProcessPoolExecutor(1, mp_context=mp.get_context('spawn')) as executor:
+        return executor.submit(fn, **kwargs).result()
+
+
+def benchmark_scaling(n_neurons=(1000,), batch_size=(1,), seq_len=(100,), max_delay=(5,), dtype=('float32',),
+                      connection_probability=(.05,), modes=('inference', 'train'), n_input=1000, n_repeats=3,
+                      isolate=True, seed=3000):
+    # Sweep of create_model throughput over every combination of the given values. A failing case
+    # (e.g. out of memory) is recorded with its error instead of stopping the sweep
+    results = []
+    for case in itertools.product(n_neurons, batch_size, seq_len, max_delay, dtype, connection_probability, modes):
+        config = dict(zip(['n_neurons', 'batch_size', 'seq_len', 'max_delay', 'dtype', 'connection_probability',
+                           'mode'], case))
+        kwargs = dict(config, n_input=n_input, n_repeats=n_repeats, seed=seed)
+        try:
+            measures = run_isolated(scaling_case, **kwargs) if isolate else scaling_case(**kwargs)
+            print(f'> {config}: {measures["steps_per_s"]:.1f} steps/s, '
+                  f'{measures["ms_per_simulated_s"]:.0f} ms per simulated s, trace {measures["trace_time"]:.1f} s, '
+                  f'peak RSS {measures["peak_rss_mb"]:.0f} MB')
+        except Exception as e:
+            measures = dict(error=repr(e))
+            print(f'> {config}: failed with {e!r}')
+        results.append(dict(config, **measures))
+    return results
+
+
+def _case_key(result):
+    return tuple(result[k] for k in ['n_neurons', 'batch_size', 'seq_len', 'max_delay', 'dtype',
+                                     'connection_probability', 'mode'])
+
+
+def compare_to_baseline(results, baseline, tolerance=.1):
+    # Relative change of the throughput of every case that is also in the baseline (a list of results,
+    # as stored by save_results). Cases slower than the baseline by more than tolerance are regressions
+    baseline = {_case_key(a): a for a in baseline if 'error' not in a}
+    comparison = []
+    for result in results:
+        key = _case_key(result)
+        if key not in baseline or 'error' in result:
+            continue
+        change = result['steps_per_s'] / baseline[key]['steps_per_s'] - 1
+        comparison.append(dict(case=key, change=change, regression=change < -tolerance,
+                               peak_rss_change=result['peak_rss_mb'] / baseline[key]['peak_rss_mb'] - 1))
+        print(f'> {key}: {change:+.1%} steps/s, {comparison[-1]["peak_rss_change"]:+.1%} peak RSS'
+              + (' REGRESSION' if comparison[-1]['regression'] else ''))
+    return comparison
+
+
+def save_results(results, path):
+    with open(path, 'w') as f:
+        json.dump(results, f, indent=2)
+
+
+def load_results(path):
+    with open(path, 'r') as f:
+        return json.load(f)
+
+
+if __name__ == '__main__':
+    # e.g. python benchmarks.py --n_neurons 1000 10000 --batch_size 1 4 --output new.json --baseline old.json
+    parser = argparse.ArgumentParser(description='Scaling benchmark of create_model on synthetic networks')
+    parser.add_argument('--n_neurons', type=int, nargs='+', default=[1000])
+    parser.add_argument('--batch_size', type=int, nargs='+', default=[1])
+    parser.add_argument('--seq_len', type=int, nargs='+', default=[100])
+    parser.add_argument('--max_delay', type=int, nargs='+', default=[5])
+    parser.add_argument('--dtype', nargs='+', default=['float32'])
+    parser.add_argument('--connection_probability', type=float, nargs='+', default=[.05])
+    parser.add_argument('--modes', nargs='+', default=['inference', 'train'])
+    parser.add_argument('--n_input', type=int, default=1000)
+    parser.add_argument('--n_repeats', type=int, default=3)
+    parser.add_argument('--no_isolate', action='store_true')
+    parser.add_argument('--output', default=None)
+    parser.add_argument('--baseline', default=None)
+    parser.add_argument('--tolerance', type=float, default=.1)
+    args = parser.parse_args()
+
+    scaling_results = benchmark_scaling(
+        n_neurons=args.n_neurons, batch_size=args.batch_size, seq_len=args.seq_len, max_delay=args.max_delay,
+        dtype=args.dtype, connection_probability=args.connection_probability, modes=args.modes,
+        n_input=args.n_input, n_repeats=args.n_repeats, isolate=not args.no_isolate)
+    if args.output is not None:
+        save_results(scaling_results, args.output)
+    if args.baseline is not None:
+        regressions = [a for a in compare_to_baseline(scaling_results, load_results(args.baseline), args.tolerance)
+                       if a['regression']]
+        if regressions:
+            raise SystemExit(f'{len(regressions)} cases slower than the baseline')
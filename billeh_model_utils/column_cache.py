@@ -0,0 +1,51 @@
+import os
+import shutil
+
+import numpy as np
+
+import array_store
+import models
+
+
+def network_hash(network, input_population, bkg_weights):
+    # Fingerprint of everything preprocess_column reads from the network
+    arrays = [network['node_type_ids'], network['synapses']['indices'], network['synapses']['weights'],
+              network['synapses']['delays'], np.array(network['synapses']['dense_shape']),
+              input_population['indices'], input_population['weights'], np.array(input_population['n_inputs']),
+              bkg_weights]
+    arrays += [network['node_params'][name] for name in sorted(network['node_params'])]
+    return array_store.hash_arrays(*arrays)
+
+
+class ColumnCache:
+    # Directory of preprocessed BillehColumn arrays (see models.preprocess_column), one subdirectory per
+    # network and (dt, max_delay). They are opened memory-mapped and read-only, so that
+    # BillehColumn(None, None, None, preprocessed=cache.get(...)) or create_model(..., preprocessed=...)
+    # skip all the NumPy preparation (the cell must be given the same dt and max_delay as get).
+    # key identifies the network (e.g. the flags of cached_load_billeh); without it the network arrays
+    # are hashed. With a key, a cached entry is loaded without the network
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, key, dt=1., max_delay=5):
+        return os.path.join(self.directory, f'column_{key}_dt{dt}_d{max_delay}')
+
+    def get(self, network=None, input_population=None, bkg_weights=None, dt=1., max_delay=5, key=None):
+        if key is None:
+            key = network_hash(network, input_population, bkg_weights)[:16]
+        path = self.path(key, dt, max_delay)
+        if os.path.exists(path) and 'requested_max_delay' not in array_store.load_arrays(path, mmap_mode='r'):
+            # written before preprocess_column recorded the requested max_delay
+            shutil.rmtree(path)
+        if not os.path.exists(path):
+            if network is None:
+                raise ValueError(f'The column {key} is not cached and no network was given')
+            preprocessed = models.preprocess_column(network, input_population, bkg_weights, dt=dt, max_delay=max_delay)
+            # written to a temporary directory first so that an interrupted run never leaves a broken entry
+            tmp_path = path + '.tmp'
+            shutil.rmtree(tmp_path, ignore_errors=True)
+            array_store.save_arrays(preprocessed, tmp_path, min_size=0)
+            os.replace(tmp_path, path)
+            print(f'> Cached preprocessed column in {path}')
+        return array_store.load_arrays(path, mmap_mode='r')
@@ -0,0 +1,142 @@
+import json
+import os
+
+import tensorflow as tf
+
+
+def configure_virtual_cpus(n_devices):
+    # Split the physical CPU into n_devices logical devices so that data parallelism
+    # can be exercised on a single machine. It has to run before TF initializes its devices
+    cpus = tf.config.list_physical_devices('CPU')
+    tf.config.set_logical_device_configuration(
+        cpus[0], [tf.config.LogicalDeviceConfiguration() for _ in range(n_devices)])
+    return tf.config.list_logical_devices('CPU')
+
+
+def local_tf_config(n_workers, worker_index, base_port=20000):
+    # Cluster description for n_workers processes running on this machine. Every process
+    # must call it (with its own worker_index) before creating the MultiWorkerMirroredStrategy
+    tf_config = dict(
+        cluster=dict(worker=[f'localhost:{base_port + i}' for i in range(n_workers)]),
+        task=dict(type='worker', index=worker_index))
+    os.environ['TF_CONFIG'] = json.dumps(tf_config)
+    return tf_config
+
+
+def get_strategy(n_devices=None, multi_worker=False):
+    if multi_worker:
+        # Each local process reads its role from TF_CONFIG (see local_tf_config)
+        communication_options = tf.distribute.experimental.CommunicationOptions(
+            implementation=tf.distribute.experimental.CommunicationImplementation.RING)
+        return tf.distribute.MultiWorkerMirroredStrategy(communication_options=communication_options)
+    devices = [d.name for d in tf.config.list_logical_devices('CPU')]
+    if n_devices is not None:
+        devices = devices[:n_devices]
+    # NCCL is not available on CPU, so the replicas reduce their gradients on a single device
+    return tf.distribute.MirroredStrategy(
+        devices=devices, cross_device_ops=tf.distribute.ReductionToOneDevice())
+
+
+def densify_gradient(grad):
+    # The gradients of recurrent_weight_values and input_weight_values have one entry per synapse.
+    # If they arrive as IndexedSlices the strategy all-gathers them (values and indices of every
+    # replica concatenated), which for tens of millions of synapses is far more expensive
+    # than a dense all-reduce of the weight vector
+    if isinstance(grad, tf.IndexedSlices):
+        return tf.convert_to_tensor(grad)
+    return grad
+
+
+def _pad_to_bucket(x, y, buckets):
+    # Zero-pad the batch of x and y to the smallest bucket that holds it, with a sample weight of 0
+    # for the padded examples
+    batch_size = tf.shape(y)[0]
+    buckets = tf.constant(buckets, tf.int32)
+    padded_batch_size = tf.gather(buckets, tf.argmax(tf.cast(buckets >= batch_size, tf.int32)))
+    tf.debugging.assert_less_equal(batch_size, padded_batch_size, message='No bucket holds the batch')
+
+    def _pad(_a):
+        _pad_widths = [[0, padded_batch_size - batch_size]] + [[0, 0]] * (len(_a.shape) - 1)
+        return tf.pad(_a, _pad_widths)
+
+    weight = tf.pad(tf.ones((batch_size,)), [[0, padded_batch_size - batch_size]])
+    return tf.nest.map_structure(_pad, x), _pad(y), weight
+
+
+class DistributedTrainer:
+    def __init__(self, strategy, model_fn, optimizer_fn, loss_fn, global_batch_size, batch_buckets=None):
+        # model_fn and optimizer_fn are called inside the strategy scope so that every
+        # variable (including the sparse weight values) is mirrored across the replicas.
+        # loss_fn must return one loss value per example, e.g.
+        # tf.keras.losses.sparse_categorical_crossentropy for the output of create_model.
+        # With batch_buckets (a list of sizes, or 'pow2', see simulation.bucket_size) every batch is
+        # zero-padded to the next bucket and the padded examples get a loss weight of 0, so that the
+        # train step is only traced once per bucket. The buckets must be multiples of the number of
+        # replicas. trace_count counts the traces
+        self.strategy = strategy
+        self._loss_fn = loss_fn
+        self._global_batch_size = global_batch_size
+        self.batch_buckets = batch_buckets
+        self.trace_count = 0
+        self._train_steps = dict()
+        with strategy.scope():
+            self.model = model_fn()
+            self.optimizer = optimizer_fn()
+
+    def _replica_step(self, x, y, weight=None):
+        with tf.GradientTape() as tape:
+            prediction = self.model(x, training=True)
+            per_example_loss = self._loss_fn(y, prediction)
+            # Every replica sees global_batch_size / n_replicas examples, so normalizing by the
+            # global batch size makes the summed all-reduce equal to the single device gradient
+            loss = tf.nn.compute_average_loss(
+                per_example_loss, sample_weight=weight, global_batch_size=self._global_batch_size)
+            if self.model.losses:
+                loss += tf.nn.scale_regularization_loss(tf.add_n(self.model.losses))
+        variables = self.model.trainable_variables
+        grads = tape.gradient(loss, variables)
+        grads = [densify_gradient(g) for g in grads]
+        # The optimizer all-reduces (sums) the gradients across replicas and applies
+        # the SignedConstraint of the sparse weights after the update
+        self.optimizer.apply_gradients(zip(grads, variables))
+        return loss
+
+    def _distributed_step(self, x, y, weight=None):
+        self.trace_count += 1
+        per_replica_loss = self.strategy.run(self._replica_step, args=(x, y, weight))
+        return self.strategy.reduce(tf.distribute.ReduceOp.SUM, per_replica_loss, axis=None)
+
+    @tf.function
+    def distributed_train_step(self, x, y):
+        return self._distributed_step(x, y)
+
+    def distribute_dataset(self, dataset):
+        # dataset must yield ((lgn_input, state_input), label) batched by the global batch size.
+        # With batch_buckets the distributed dataset yields (x, label, weight) padded batches
+        if self.batch_buckets is not None:
+            if self.batch_buckets == 'pow2':
+                buckets = [2 ** i for i in range(31)]
+            else:
+                buckets = sorted(self.batch_buckets)
+            dataset = dataset.map(lambda _x, _y: _pad_to_bucket(_x, _y, buckets))
+        return self.strategy.experimental_distribute_dataset(dataset)
+
+    def _train_step(self, element_spec):
+        # The step is traced once per element spec of the dataset and kept for the next calls of train
+        # (batch the dataset with drop_remainder=True so that a smaller last batch does not change the spec).
+        # The padded batches have no static batch size, so with batch_buckets the step has no input
+        # signature and is traced once per concrete (bucket) shape instead
+        key = 'buckets' if self.batch_buckets is not None else element_spec
+        if key not in self._train_steps:
+            input_signature = None if self.batch_buckets is not None else list(element_spec)
+            self._train_steps[key] = tf.function(self._distributed_step, input_signature=input_signature)
+        return self._train_steps[key]
+
+    def train(self, dataset, n_steps):
+        losses = []
+        dist_dataset = self.distribute_dataset(dataset)
+        train_step = self._train_step(dist_dataset.element_spec)
+        it = iter(dist_dataset)
+        for _ in range(n_steps):
+            losses.append(float(train_step(*next(it))))
+        return losses
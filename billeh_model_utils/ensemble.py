@@ -0,0 +1,142 @@
+import numpy as np
+import tensorflow as tf
+
+import models
+import simulation
+
+
+def _per_variant(value, n_variants):
+    value = np.asarray(value, np.float32)
+    if value.ndim == 0:
+        value = np.full(n_variants, value, np.float32)
+    if value.shape != (n_variants,):
+        raise ValueError(f'Expected a scalar or {n_variants} values, got shape {value.shape}')
+    return value
+
+
+def split_ensemble(x, n_variants):
+    # (..., n_variants * m) outputs or state of EnsembleColumn to (..., n_variants, m)
+    x = np.asarray(x)
+    return x.reshape(x.shape[:-1] + (n_variants, -1))
+
+
+class EnsembleColumn(models.BillehColumn):
+    # n_variants copies of the column that share the sparsity structure of the synapses but each have
+    # their own weight values and parameters: recurrent_weight_scale, input_weight_scale and lr_scale are
+    # scalars or one value per variant, and v_th (optional) is the threshold in mV of every node type for
+    # each variant, with shape (n_variants, n_types). The variants are stacked variant-major along the last
+    # axis of the inputs, outputs and state (see split_ensemble). The recurrent weights of all the variants
+    # form a single block-diagonal sparse matrix and the input weights a single row-stacked one, so every
+    # step runs one sparse matmul for the whole ensemble. All the variants see the same background noise
+    def __init__(self, network, input_population, bkg_weights, n_variants, recurrent_weight_scale=1.,
+                 input_weight_scale=1., lr_scale=1., v_th=None, **kwargs):
+        if kwargs.get('probes') is not None or kwargs.get('accumulate_statistics', False):
+            raise ValueError('EnsembleColumn does not support probes nor accumulated statistics')
+        super().__init__(network, input_population, bkg_weights, **kwargs)
+        self.n_variants = n_variants
+        lr_scale = _per_variant(lr_scale, n_variants)
+        recurrent_weight_scale = _per_variant(recurrent_weight_scale, n_variants)
+        input_weight_scale = _per_variant(input_weight_scale, n_variants)
+        self._ensemble_lr_scale = tf.constant(lr_scale, self._compute_dtype)
+        self.state_size = tuple(n_variants * a for a in self.state_size)
+
+        # the weights of the base class (scales of 1) are tiled with the scale of every variant, and the
+        # synapses of variant e are shifted by e blocks of rows (and of delayed sources, for the recurrent ones)
+        def _tile(_values, _scale):
+            return (_values.numpy()[None] * _scale[:, None]).reshape(-1)
+
+        def _shift(_indices, _block):
+            _offsets = np.arange(n_variants)[:, None, None] * np.array(_block)
+            return (_indices.numpy()[None] + _offsets).reshape(-1, 2)
+
+        train_recurrent = self.recurrent_weight_values.trainable
+        train_input = self.input_weight_values.trainable
+        n_rows, n_delayed_sources = self.recurrent_dense_shape
+        self.recurrent_weight_positive = tf.Variable(
+            np.tile(self.recurrent_weight_positive.numpy(), n_variants), name='recurrent_weights_sign',
+            trainable=False)
+        self.recurrent_weight_values = tf.Variable(
+            _tile(self.recurrent_weight_values, recurrent_weight_scale / lr_scale), name='sparse_recurrent_weights',
+            constraint=models.SignedConstraint(self.recurrent_weight_positive), trainable=train_recurrent)
+        self.recurrent_indices = tf.Variable(
+            _shift(self.recurrent_indices, (n_rows, n_delayed_sources)), trainable=False)
+        self.recurrent_dense_shape = (n_variants * n_rows, n_variants * n_delayed_sources)
+
+        n_rows, n_inputs = self.input_dense_shape
+        self.input_weight_positive = tf.Variable(
+            np.tile(self.input_weight_positive.numpy(), n_variants), name='input_weights_sign', trainable=False)
+        self.input_weight_values = tf.Variable(
+            _tile(self.input_weight_values, input_weight_scale / lr_scale), name='sparse_input_weights',
+            constraint=models.SignedConstraint(self.input_weight_positive), trainable=train_input)
+        self.input_indices = tf.Variable(_shift(self.input_indices, (n_rows, 0)), trainable=False)
+        self.input_dense_shape = (n_variants * n_rows, n_inputs)
+        self.bkg_weights = tf.Variable(
+            np.tile(self.bkg_weights.numpy(), n_variants), name='rest_of_brain_weights', trainable=train_input)
+
+        self.ensemble_v_th = None
+        if v_th is not None:
+            v_th = np.asarray(v_th, np.float32)
+            type_voltage_scale = self.type_voltage_scale
+            type_voltage_offset = self.type_voltage_offset
+            if v_th.shape != (n_variants, len(type_voltage_scale)):
+                raise ValueError(f'v_th must have shape {(n_variants, len(type_voltage_scale))}, got {v_th.shape}')
+            self.ensemble_v_th = tf.Variable(tf.cast(
+                (v_th - type_voltage_offset) / type_voltage_scale, self._compute_dtype),
+                name='ensemble_v_th', trainable=False)
+
+    def zero_state(self, batch_size, dtype=tf.float32):
+        return tuple(tf.tile(a, (1, self.n_variants)) for a in super().zero_state(batch_size, dtype))
+
+    def ensemble_params(self, batch_size):
+        # neuron_params for the (batch * n_variants, n_neurons) layout used by the neuron update
+        params = self.step_params()
+        if self.ensemble_v_th is not None:
+            v_th = tf.gather(self.ensemble_v_th, self._node_type_ids, axis=1)
+            params['v_th'] = tf.reshape(
+                tf.broadcast_to(v_th[None], (batch_size, self.n_variants, self._n_neurons)), (-1, self._n_neurons))
+        return params
+
+    def call(self, inputs, state, constants=None):
+        # inputs is the external current of every variant, (batch, n_variants * n_neurons * n_receptors)
+        n_variants = self.n_variants
+        n_neurons = self._n_neurons
+        z_buf, v, r, asc_1, asc_2, psc_rise, psc = state
+
+        def _fold(_x):
+            return tf.reshape(_x, (-1, n_neurons))
+
+        def _unfold(_x):
+            return tf.reshape(_x, (-1, n_variants * _x.shape[-1]))
+
+        shaped_z_buf = tf.reshape(z_buf, (-1, n_variants, self.max_delay, n_neurons))
+        prev_z = _fold(shaped_z_buf[:, :, 0])
+
+        dampened_z_buf = z_buf * self._recurrent_dampening
+        rec_z_buf = tf.stop_gradient(z_buf - dampened_z_buf) + dampened_z_buf
+
+        rec_inputs = self._recurrent_current(rec_z_buf)
+        rec_inputs = tf.reshape(rec_inputs + inputs, (-1, n_variants, n_neurons * self._n_receptors))
+        rec_inputs = rec_inputs * self._ensemble_lr_scale[:, None]
+        rec_inputs = tf.reshape(rec_inputs, (-1, n_neurons, self._n_receptors))
+
+        params = self.ensemble_params(tf.shape(z_buf)[0])
+        new_z, new_v, new_r, new_asc_1, new_asc_2, new_psc_rise, new_psc, input_current = \
+            self._neuron_update(rec_inputs, prev_z, _fold(v), _fold(r), _fold(asc_1), _fold(asc_2),
+                                psc_rise, psc, params=params)
+
+        new_shaped_z_buf = tf.concat(
+            (tf.reshape(new_z, (-1, n_variants, 1, n_neurons)), shaped_z_buf[:, :, :-1]), 2)
+        new_z_buf = tf.reshape(new_shaped_z_buf, (-1, n_variants * self.max_delay * n_neurons))
+
+        outputs = (_unfold(new_z), _unfold(new_v * params['voltage_scale'] + params['voltage_offset']),
+                   _unfold(input_current + new_asc_1 + new_asc_2))
+        new_state = (new_z_buf, _unfold(new_v), _unfold(new_r), _unfold(new_asc_1), _unfold(new_asc_2),
+                     _unfold(new_psc_rise), _unfold(new_psc))
+        return outputs, new_state
+
+
+class EnsembleSimulator(simulation.ChunkedSimulator):
+    # ChunkedSimulator of an EnsembleColumn (n_variants and the per variant parameters are passed as
+    # cell keyword arguments). Every trial of the batch runs in all the variants: with
+    # spike_format='events' the neuron of an event is variant * n_neurons + neuron
+    cell_class = EnsembleColumn
@@ -0,0 +1,65 @@
+import hashlib
+import os
+
+import numpy as np
+import tensorflow as tf
+
+import array_store
+
+
+def input_weights_hash(cell):
+    # The LGN current only depends on the input synapses of the cell (and not on the recurrent ones)
+    return array_store.hash_arrays(cell.input_indices.numpy(), cell.input_weight_values.numpy(),
+                        np.array(cell.input_dense_shape))
+
+
+def stimulus_hash(lgn_input):
+    return array_store.hash_arrays(np.asarray(lgn_input, np.float32))
+
+
+def compute_input_current(cell, lgn_input, chunk_len=500, out=None):
+    # Deterministic LGN current (batch, seq_len, n_receptors * n_neurons) of lgn_input (batch, seq_len, n_inputs),
+    # the same product as SparseLayer without the background noise. It is computed chunk_len steps at a time
+    # and written into out if given (e.g. a memory-mapped array)
+    batch_size, seq_len = lgn_input.shape[:2]
+    if out is None:
+        out = np.zeros((batch_size, seq_len, cell.input_dense_shape[0]), np.float32)
+    current_fn = tf.function(cell.compute_input_current, reduce_retracing=True)
+    for start in range(0, seq_len, chunk_len):
+        lgn_chunk = tf.constant(lgn_input[:, start:start + chunk_len], tf.float32)
+        out[:, start:start + chunk_len] = current_fn(lgn_chunk).numpy()
+    return out
+
+
+class InputCurrentCache:
+    # Directory of precomputed LGN currents, one .npy per (stimulus, input weights) pair, that are opened
+    # memory-mapped so that ChunkedSimulator.run(input_current=...) streams them chunk by chunk.
+    # Only valid while the input weights are fixed (train_input=False): their hash is part of the key,
+    # so a change of the weights simply misses the cache
+    def __init__(self, directory, chunk_len=500):
+        self.directory = directory
+        self.chunk_len = chunk_len
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, stimulus_key, weights_key):
+        # the full keys are hashed, so that caller keys of any length (and characters) give distinct file names
+        key = hashlib.sha1(f'{stimulus_key}\0{weights_key}'.encode()).hexdigest()
+        return os.path.join(self.directory, f'input_current_{key}.npy')
+
+    def get(self, cell, lgn_input, stimulus_key=None):
+        # stimulus_key identifies the stimulus (e.g. its name and trial seed), the hash of lgn_input by default
+        if stimulus_key is None:
+            stimulus_key = stimulus_hash(lgn_input)
+        path = self.path(stimulus_key, input_weights_hash(cell))
+        if not os.path.exists(path):
+            batch_size, seq_len = lgn_input.shape[:2]
+            # written to a temporary file first so that an interrupted run never leaves a broken entry
+            tmp_path = path[:-len('.npy')] + '.tmp.npy'
+            out = np.lib.format.open_memmap(
+                tmp_path, mode='w+', dtype=np.float32, shape=(batch_size, seq_len, cell.input_dense_shape[0]))
+            compute_input_current(cell, lgn_input, chunk_len=self.chunk_len, out=out)
+            out.flush()
+            del out
+            os.replace(tmp_path, path)
+            print(f'> Cached input current in {path}')
+        return np.load(path, mmap_mode='r')
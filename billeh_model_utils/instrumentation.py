@@ -0,0 +1,147 @@
+import contextlib
+import csv
+import resource
+import time
+
+import numpy as np
+import tensorflow as tf
+
+
+def peak_rss_mb():
+    # High-water mark of the resident memory of this process (ru_maxrss is in kB on Linux)
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def _sync(x):
+    # Reading a single element waits for the computation of x to finish (needed on GPU)
+    return tf.reshape(x, (-1,))[:1].numpy()
+
+
+class ChunkProfiler:
+    # Opt-in instrumentation of ChunkedSimulator.run (pass it as profiler=...). For every chunk it records:
+    #  - the wall time of the input layer (SparseLayer), of the recurrent network (BillehColumn over
+    #    the chunk) and the remaining Python overhead of the chunk
+    #  - the number of spikes, and the number of recurrent synapses they touch (spikes x out-degree),
+    #    which is what the cost of the recurrent sparse matmul follows
+    #  - the peak resident memory of the process
+    # With cell_phases=True the recurrent sparse matmul and the elementwise neuron update are also timed
+    # separately, by running each of them n_repeats times on the state at the end of the chunk.
+    # When no profiler is given the simulator runs its usual fused chunk function, so nothing is paid.
+    # The first chunk includes the tracing of the phase functions
+    def __init__(self, cell_phases=False, n_repeats=10):
+        self.records = []
+        self._cell_phases = cell_phases
+        self._n_repeats = n_repeats
+        self._out_degree = None
+        self._fns = None
+
+    def _setup(self, simulator):
+        cell = simulator.cell
+        # the variants of an EnsembleColumn share the synapses, so the out-degree of a neuron is counted
+        # once per variant
+        sources = cell.recurrent_indices.numpy()[:, 1] % cell._n_sources
+        n_variants = getattr(cell, 'n_variants', 1)
+        self._out_degree = np.bincount(sources, minlength=cell._n_sources) // n_variants
+        self._fns = dict(
+            input=tf.function(simulator._input_phase, reduce_retracing=True),
+            rnn=tf.function(simulator._rnn_phase, reduce_retracing=True),
+            recurrent=tf.function(cell._recurrent_current),
+            update=tf.function(self._neuron_update_fn(cell)))
+
+    @staticmethod
+    def _neuron_update_fn(cell):
+        def _update(rec_inputs, state):
+            _, v, r, asc_1, asc_2, psc_rise, psc = state[:7]
+            shaped_z_buf = tf.reshape(state[0], (-1, cell.max_delay, cell._n_neurons))
+            rec_inputs = tf.reshape(rec_inputs, (-1, cell._n_neurons, cell._n_receptors))
+            return cell._neuron_update(rec_inputs, shaped_z_buf[:, 0], v, r, asc_1, asc_2, psc_rise, psc,
+                                       params=cell.neuron_params())[0]
+        return _update
+
+    def _time(self, fn, *args):
+        t0 = time.perf_counter()
+        for _ in range(self._n_repeats):
+            result = fn(*args)
+        _sync(tf.nest.flatten(result)[0])
+        return (time.perf_counter() - t0) / self._n_repeats
+
+    def profile_chunk(self, simulator, lgn_chunk, state, start, batch_size=None):
+        # batch_size is the number of trials of the chunk without the padding of the batch buckets
+        if self._fns is None:
+            self._setup(simulator)
+        t0 = time.perf_counter()
+        with tf.profiler.experimental.Trace('input_layer', step_num=start, _r=1):
+            rnn_inputs = self._fns['input'](lgn_chunk)
+            _sync(rnn_inputs)
+        t1 = time.perf_counter()
+        with tf.profiler.experimental.Trace('rsnn', step_num=start, _r=1):
+            outputs, state = self._fns['rnn'](rnn_inputs, state)
+            _sync(state[1])
+        t2 = time.perf_counter()
+
+        n_steps = lgn_chunk.shape[1]
+        if batch_size is None:
+            batch_size = lgn_chunk.shape[0]
+        # the padded trials are left out, and the neuron ids of an ensemble (variant * n_neurons + neuron)
+        # are reduced to the neuron
+        n_neurons = len(self._out_degree)
+        if simulator.spike_format == 'events':
+            events = outputs[0].numpy()
+            spiking_ids = events[events[:, 0] < batch_size, 2] % n_neurons
+            n_spikes = len(spiking_ids)
+            nnz_touched = int(np.sum(self._out_degree[spiking_ids]))
+        else:
+            spike_counts = tf.reduce_sum(tf.cast(outputs[0][:batch_size], tf.float32), (0, 1)).numpy()
+            n_spikes = int(np.sum(spike_counts))
+            nnz_touched = int(np.sum(spike_counts.reshape((-1, n_neurons)) * self._out_degree))
+        record = dict(
+            start=start, n_steps=n_steps, batch_size=batch_size,
+            input_time=t1 - t0, rnn_time=t2 - t1, overhead_time=time.perf_counter() - t2,
+            n_spikes=n_spikes, spikes_per_step=n_spikes / (batch_size * n_steps),
+            nnz_touched=nnz_touched, peak_rss_mb=peak_rss_mb())
+
+        if self._cell_phases:
+            # per step timings, measured on the state at the end of the chunk
+            rec_inputs = self._fns['recurrent'](state[0])
+            record['recurrent_time_per_step'] = self._time(self._fns['recurrent'], state[0])
+            record['update_time_per_step'] = self._time(self._fns['update'], rec_inputs, state)
+        self.records.append(record)
+        return outputs, state
+
+    def summary(self):
+        # Totals over all the recorded chunks
+        total = dict()
+        for key in ['n_steps', 'input_time', 'rnn_time', 'overhead_time', 'n_spikes', 'nnz_touched']:
+            total[key] = sum([a[key] for a in self.records])
+        total['peak_rss_mb'] = max([a['peak_rss_mb'] for a in self.records])
+        return total
+
+    def to_csv(self, path):
+        fieldnames = list(self.records[0].keys())
+        with open(path, 'w', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=fieldnames)
+            writer.writeheader()
+            writer.writerows(self.records)
+
+    def write_summaries(self, logdir):
+        # The per chunk records as TensorBoard scalars, with the first step of the chunk as step
+        writer = tf.summary.create_file_writer(logdir)
+        with writer.as_default():
+            for record in self.records:
+                for key, value in record.items():
+                    if key != 'start':
+                        tf.summary.scalar(key, value, step=record['start'])
+        writer.flush()
+
+
+@contextlib.contextmanager
+def tensorboard_trace(logdir):
+    # Op level TensorBoard profile of everything run inside the context, e.g.
+    #   with tensorboard_trace(logdir):
+    #       simulator.run(lgn_input, profiler=ChunkProfiler())
+    # The phases of ChunkProfiler appear in the trace as input_layer and rsnn
+    tf.profiler.experimental.start(logdir)
+    try:
+        yield
+    finally:
+        tf.profiler.experimental.stop()
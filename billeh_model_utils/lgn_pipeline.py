@@ -0,0 +1,106 @@
+import numpy as np
+import tensorflow as tf
+
+
+def probability_to_rate(p):
+    # Decoding used by plotting_utils.RasterPlot for the stored rate traces (rate in Hz)
+    return -np.log(1 - p / 1.3) * 1000
+
+
+def _expected_spikes(rate, dt):
+    # Expected number of spikes of a Poisson process in a bin of dt ms
+    return tf.cast(rate, tf.float32) * dt / 1000
+
+
+def events_to_dense(events, seq_len, n_input, dt=1.):
+    # (n_spikes, 2) spike times (ms) and LGN unit ids -> (seq_len, n_input) spike counts per bin
+    events = tf.convert_to_tensor(events)
+    bins = tf.cast(tf.cast(events[:, 0], tf.float32) / dt, tf.int64)
+    units = tf.cast(events[:, 1], tf.int64)
+    sel = tf.logical_and(bins >= 0, bins < seq_len)
+    positions = tf.stack([tf.boolean_mask(bins, sel), tf.boolean_mask(units, sel)], -1)
+    counts = tf.ones_like(positions[:, 0], tf.float32)
+    return tf.scatter_nd(positions, counts, (seq_len, n_input))
+
+
+def lgn_dataset(seq_len, n_input, n_neurons, batch_size, rates=None, spike_events=None, labels=None,
+                rate_format='hz', dt=1., deterministic=False, cache=None, shuffle=True, repeat=True,
+                seed=3000, num_parallel_calls=tf.data.AUTOTUNE, prefetch=tf.data.AUTOTUNE):
+    # tf.data pipeline of LGN inputs for create_model, yielding ((lgn_spikes, state_input), label) batches,
+    # with lgn_spikes of shape (batch_size, seq_len, n_input) and a zero state_input.
+    # The stimuli are either
+    #  - rates: (n_stimuli, seq_len, n_input) rate traces (an np.memmap is only read as needed), in Hz or, with
+    #    rate_format='probability', in the encoding decoded by RasterPlot. The spikes are sampled on the fly
+    #    as Poisson counts per bin, like the spike counts of load_input
+    #  - spike_events: a list with one (n_spikes, 2) array of spike times (ms) and unit ids per stimulus
+    # The generation runs in parallel (num_parallel_calls) and is prefetched, so it overlaps with the
+    # simulation. With deterministic=True the spikes of every stimulus are sampled from a fixed seed, so
+    # that they can be cached (cache='' in memory or a file path); otherwise only the loaded rates are cached.
+    # Without cache only the stimulus indices are shuffled, so no stimulus is generated before it is needed;
+    # with cache the cached elements are shuffled, since a shuffle before the cache would fix the order
+    if (rates is None) == (spike_events is None):
+        raise ValueError('Give either rates or spike_events')
+    n_stimuli = len(rates) if rates is not None else len(spike_events)
+    if labels is None:
+        labels = np.zeros(n_stimuli, np.int32)
+    labels = np.asarray(labels)
+
+    dataset = tf.data.Dataset.from_tensor_slices((np.arange(n_stimuli, dtype=np.int64), labels))
+    if shuffle and cache is None:
+        dataset = dataset.shuffle(n_stimuli, seed=seed, reshuffle_each_iteration=True)
+
+    def _shuffle_cached(_dataset):
+        if shuffle and cache is not None:
+            _dataset = _dataset.shuffle(n_stimuli, seed=seed, reshuffle_each_iteration=True)
+        return _dataset
+
+    if rates is not None:
+        def _read_rates(_index):
+            _stimulus = np.asarray(rates[_index], np.float32)
+            if rate_format == 'probability':
+                _stimulus = probability_to_rate(_stimulus)
+            return _stimulus.astype(np.float32)
+
+        def _load(index, label):
+            stimulus = tf.numpy_function(_read_rates, [index], tf.float32)
+            stimulus = tf.ensure_shape(stimulus, (seq_len, n_input))
+            return index, stimulus, label
+
+        def _sample(index, stimulus, label):
+            lam = _expected_spikes(stimulus, dt)
+            if deterministic:
+                counts = tf.random.stateless_poisson(
+                    tf.shape(lam), seed=tf.stack([tf.cast(seed, tf.int64), index]), lam=lam)
+            else:
+                counts = tf.random.poisson((), lam)
+            return counts, label
+
+        dataset = dataset.map(_load, num_parallel_calls=num_parallel_calls)
+        if cache is not None and not deterministic:
+            dataset = _shuffle_cached(dataset.cache(cache))
+        dataset = dataset.map(_sample, num_parallel_calls=num_parallel_calls)
+    else:
+        lengths = np.array([len(a) for a in spike_events], np.int64)
+        values = np.concatenate([np.reshape(a, (-1, 2)) for a in spike_events]).astype(np.float32)
+        offsets = np.concatenate([[0], np.cumsum(lengths)])
+
+        def _load_events(index, label):
+            events = tf.gather(values, tf.range(tf.gather(offsets, index), tf.gather(offsets, index + 1)))
+            return events_to_dense(events, seq_len, n_input, dt), label
+
+        dataset = dataset.map(_load_events, num_parallel_calls=num_parallel_calls)
+        # the spikes of the stimuli are fixed, so they are always deterministic
+        deterministic = True
+
+    if cache is not None and deterministic:
+        dataset = _shuffle_cached(dataset.cache(cache))
+    if repeat:
+        dataset = dataset.repeat()
+    dataset = dataset.batch(batch_size, drop_remainder=True)
+
+    def _model_inputs(lgn_spikes, label):
+        state_input = tf.zeros((batch_size, seq_len, n_neurons))
+        return (lgn_spikes, state_input), label
+
+    dataset = dataset.map(_model_inputs, num_parallel_calls=num_parallel_calls)
+    return dataset.prefetch(prefetch)
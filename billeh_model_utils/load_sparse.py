@@ -5,6 +5,8 @@ import h5py
 import numpy as np
 import pandas as pd
 from numba import njit
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import reverse_cuthill_mckee
 
 
 @njit
@@ -16,82 +18,70 @@ def sort_indices(indices, weights, delays):
     return indices[sorted_ind], weights[sorted_ind], delays[sorted_ind]
 
 
-# def get_model_params(d, d_index):
-#     params_dict = d['nodes'][d_index]['params']
-
-#     new_params_dict = {
-#         # rest potential (also reset value)
-#         'EL_reference': params_dict['E_L']*10**-3,
-#         'EL': 0,
-#         'C': params_dict['C_m']*10**-12,
-#         'R_input': 1/(params_dict['g']*10**-9),
-#         'tau': (1/(params_dict['g']*10**-9))*params_dict['C_m']*10**-12,
-#         'asc_amp_array': np.array(params_dict['asc_amps'])*10**-12,
-#         'asc_tau_array': 1/(np.array(params_dict['k'])*10**3),
-#         'th_inf': (params_dict['V_th'] - params_dict['E_L'])*10**-3,
-#         'dt': 10**-3,
-#         #dt:1.0 / sweep_data['sampling_rate']
-#     }
-
-#     return new_params_dict
-
-
-# @njit
-# def Ij1(Ij, asc_tau_array, dt):
-#     Ij1 = Ij*np.exp(-(1/asc_tau_array)*dt)
-#     return Ij1
-
-
-# @njit
-# def dV(I_ext, Ij, V, C, R_input, EL):
-#     dV = (1/C)*(I_ext + np.sum(Ij) - (1/R_input)*(V-EL))
-#     return dV
-
-
-# def calculate_rheobase(new_params_dict):
-#     EL = new_params_dict['EL']
-#     C = new_params_dict['C']
-#     R_input = new_params_dict['R_input']
-#     asc_tau_array = new_params_dict['asc_tau_array']
-#     th_inf = new_params_dict['th_inf']
-#     dt = new_params_dict['dt']
-#     rheobase = None
-#     dt = 10**-3
-#     current = 10**-11
-#     while rheobase is None:
-#         stim = np.zeros(2000)
-#         stim[0:1000] = current
-#         stim[1000:2000] = 0
-#         stimulus = stim
-#         stimulus_size = len(stimulus)
-#         V_values = np.zeros(stimulus_size)
-#         # this will remain as 0 all the time since no spike take place
-#         asc_values = np.zeros((stimulus_size, 2))
-#         V0 = V_values[0]
-#         asc0 = asc_values[0, :]
-#         time_step = 0
-#         while time_step < stimulus_size:
-#             I_ext = stimulus[time_step]
-#             V1 = V0 + dt*dV(I_ext, asc0, V0, C, R_input, EL)
-#             asc1 = Ij1(asc0, asc_tau_array, dt)
-#             if V1 > th_inf:
-#                 rheobase = current
-#                 break
-#             else:
-#                 # there was no spike, store the next voltages
-#                 V_values[time_step] = V1
-#                 asc_values[time_step, :] = asc1
-#                 V0 = V1
-#                 asc0 = asc1
-#                 time_step += 1
-#         current += 10**-14
-
-#     return rheobase
+def rheobase(node_params, duration=1000., dt=1.):
+    # Smallest constant current (pA) that makes a neuron of every node type spike within duration (ms),
+    # starting at rest. No spike has happened before the first one, so the after-spike currents are zero
+    # and the voltage relaxes exponentially towards E_L + I / g. With the exact integration of
+    # BillehColumn, after n steps V - E_L = I / g * (1 - exp(-n dt / tau)), which gives the threshold
+    # current in closed form for all the types at once (g * (V_th - E_L) for an infinite duration)
+    tau = node_params['C_m'] / node_params['g']
+    n_steps = np.round(duration / dt)
+    return node_params['g'] * (node_params['V_th'] - node_params['E_L']) / (1 - np.exp(-n_steps * dt / tau))
+
+
+def fi_curve(node_params, currents, duration=1000., dt=1.):
+    # Firing rate (Hz) of every node type for every constant current of currents (pA), with shape
+    # (n_types, n_currents). All the (type, current) pairs are simulated together, from rest, with the
+    # same update as BillehColumn (hard reset, refractory period and after-spike currents)
+    currents = np.asarray(currents, np.float64)[None]
+    p = {k: np.asarray(v, np.float64) for k, v in node_params.items()}
+    tau = p['C_m'] / p['g']
+    decay = np.exp(-dt / tau)[:, None]
+    current_factor = ((1 - decay[:, 0]) / p['g'])[:, None]
+    asc_decay = np.exp(-dt * p['k'])
+    v_th, e_l, v_reset, t_ref, g = (p[k][:, None] for k in ('V_th', 'E_L', 'V_reset', 't_ref', 'g'))
+
+    shape = (len(tau), currents.shape[1])
+    v = np.broadcast_to(e_l, shape).copy()
+    r = np.zeros(shape)
+    asc_1 = np.zeros(shape)
+    asc_2 = np.zeros(shape)
+    z = np.zeros(shape)
+    n_spikes = np.zeros(shape)
+    for _ in range(int(np.round(duration / dt))):
+        r = np.maximum(r + z * t_ref - dt, 0)
+        c1 = currents + asc_1 + asc_2 + g * e_l
+        asc_1 = asc_decay[:, 0, None] * asc_1 + z * p['asc_amps'][:, 0, None]
+        asc_2 = asc_decay[:, 1, None] * asc_2 + z * p['asc_amps'][:, 1, None]
+        v = np.where(r > 0, v_reset, decay * v + current_factor * c1)
+        z = ((v > v_th) & (r <= 0)).astype(np.float64)
+        n_spikes += z
+    return n_spikes / (duration / 1000.)
+
+
+def stratified_selection(candidates, node_type_ids, n_neurons, rd):
+    # Choose n_neurons among candidates keeping the proportion of every node type: each type gets its
+    # quota rounded down and the remaining neurons go to the types with the largest remainders.
+    # Returns the chosen ids and, for every node type, the inverse of its sampling fraction, which is the
+    # factor that keeps the expected input that a neuron receives from that type
+    types, counts = np.unique(node_type_ids[candidates], return_counts=True)
+    quota = counts * n_neurons / len(candidates)
+    n_take = np.floor(quota).astype(np.int64)
+    n_take[np.argsort(n_take - quota, kind='stable')[:n_neurons - np.sum(n_take)]] += 1
+    take_inds = np.concatenate([
+        rd.choice(candidates[node_type_ids[candidates] == t], size=k, replace=False) for t, k in zip(types, n_take)])
+    type_weight_scale = np.ones(np.max(node_type_ids) + 1, np.float32)
+    type_weight_scale[types] = counts / np.maximum(n_take, 1)
+    return take_inds, type_weight_scale
 
 
 def load_network(path='GLIF_network/network_dat.pkl',
                  h5_path='GLIF_network/network/v1_nodes.h5',
-                 core_only=True, n_neurons=None, seed=3000, connected_selection=False):
+                 core_only=True, n_neurons=None, seed=3000, connected_selection=False, stratified=False):
+    # With stratified=True (and n_neurons) the neurons are sampled per node type instead of uniformly
+    # (see stratified_selection) and the recurrent weights are rescaled by the inverse sampling fraction
+    # of their source type, so that every neuron keeps its expected recurrent input. Check how well a
+    # sampled network stands in for the full one with recurrent_input_fidelity
     rd = np.random.RandomState(seed=seed)
 
     with open(path, 'rb') as f:
@@ -110,8 +100,7 @@ def load_network(path='GLIF_network/network_dat.pkl',
   #             'V_dynamics_method': 'linear_exact',
   #             'tau_syn': [5.5, 8.5, 2.8, 5.8],
   #             't_ref': 2.2,
-  #             'asc_amps': [-6.621493991981387, -68.56339310938284]
-  #             'rheobase': [values....]}
+  #             'asc_amps': [-6.621493991981387, -68.56339310938284]}
 
   # The 'edges' key is a list of 1783 entries (one per edge class) with the following information:
   #  'source': array([   86,   195,   874, ..., 26266, 26563, 26755], dtype=uint64), # bmtk indices
@@ -131,6 +120,10 @@ def load_network(path='GLIF_network/network_dat.pkl',
     tf_id_to_bmtk_id = np.arange(n_nodes)
 
     edges = d['edges']
+    bmtk_node_type_ids = np.zeros(n_nodes, np.int64)
+    for i, node_type in enumerate(d['nodes']):
+        bmtk_node_type_ids[np.array(node_type['ids'])] = i
+    type_weight_scale = np.ones(len(d['nodes']), np.float32)
     h5_file = h5py.File(h5_path, 'r')
     # This file gives us the:
     # '0': coordinates of each point (and other information we are not using)
@@ -157,12 +150,18 @@ def load_network(path='GLIF_network/network_dat.pkl',
         sel = r < 400
         if n_neurons is not None and n_neurons > 0:
             inds, = np.where(sel)  # indices where the condition is satisfied
-            take_inds = rd.choice(inds, size=n_neurons, replace=False)
+            if stratified:
+                take_inds, type_weight_scale = stratified_selection(inds, bmtk_node_type_ids, n_neurons, rd)
+            else:
+                take_inds = rd.choice(inds, size=n_neurons, replace=False)
             sel[:] = False
             sel[take_inds] = True
     elif n_neurons is not None and n_neurons > 0:  # this condition takes random neurons from all the V1
         legit_neurons = np.arange(n_nodes)
-        take_inds = rd.choice(legit_neurons, size=n_neurons, replace=False)
+        if stratified:
+            take_inds, type_weight_scale = stratified_selection(legit_neurons, bmtk_node_type_ids, n_neurons, rd)
+        else:
+            take_inds = rd.choice(legit_neurons, size=n_neurons, replace=False)
         sel = np.zeros(n_nodes, np.bool)
         sel[take_inds] = True
 
@@ -205,12 +204,10 @@ def load_network(path='GLIF_network/network_dat.pkl',
         tau_syn=np.zeros((n_node_types, 10), np.float32), # 10 is the maximum number of synapses
         t_ref=np.zeros(n_node_types, np.float32),
         asc_amps=np.zeros((n_node_types, 2), np.float32),
-        # rheobase=np.zeros(n_node_types, np.float32)
     )
 
     # give every selected node of a given node type an index according to tf ids
     node_type_ids = np.zeros(n_nodes, np.int64)
-    # save_new_d_dict = False
     for i, node_type in enumerate(d['nodes']):
         # get ALL the nodes of the given node type
         tf_ids = bmtk_id_to_tf_id[np.array(node_type['ids'])]
@@ -219,13 +216,6 @@ def load_network(path='GLIF_network/network_dat.pkl',
         # assign them all the same id (which does not relate with the neuron type)
         node_type_ids[tf_ids] = i
 
-        # if 'rheobase' not in node_type['params'].keys():
-        #     new_params_dict = get_model_params(d, i)
-        #     rheobase = calculate_rheobase(new_params_dict)
-        #     d['nodes'][i]['params']['rheobase'] = rheobase
-        #     node_type['params']['rheobase'] = rheobase
-        #     save_new_d_dict = True
-
         for k, v in node_params.items():
             # save in a dict the information of the nodes
             if k == 'tau_syn':
@@ -233,9 +223,8 @@ def load_network(path='GLIF_network/network_dat.pkl',
             else:
                 v[i] = node_type['params'][k]  # save in a dict the information of the nodes
 
-    # if save_new_d_dict:
-    #     with open(path, 'wb') as handle:
-    #         pkl.dump(d, handle)
+    # threshold current of every type for a 1 s step, for input normalization and sanity checks
+    node_params['rheobase'] = rheobase(node_params).astype(np.float32)
 
     # each node has 10 different inputs (soma, dendrites, etc) with different properties each
     dense_shape = (10 * n_nodes, n_nodes)
@@ -255,6 +244,8 @@ def load_network(path='GLIF_network/network_dat.pkl',
         target_tf_ids = target_tf_ids[edge_exists]
         source_tf_ids = source_tf_ids[edge_exists]
         weights_tf = edge['params']['weight'][edge_exists]
+        if stratified:
+            weights_tf = weights_tf * type_weight_scale[node_type_ids[source_tf_ids]]
         # all the edges of a given type have the same delay
         delays_tf = edge['params']['delay']
         n_new_edge = np.sum(edge_exists)
@@ -280,9 +271,198 @@ def load_network(path='GLIF_network/network_dat.pkl',
         tf_id_to_bmtk_id=tf_id_to_bmtk_id,
         bmtk_id_to_tf_id=bmtk_id_to_tf_id
     )
+    if stratified:
+        network['type_weight_scale'] = type_weight_scale
     return network
 
 
+def recurrent_input_fidelity(network, reference_network):
+    # Fidelity check of a sampled network (e.g. loaded with stratified=True) against the network it
+    # stands in for (e.g. the full core, n_neurons=None): for every node type and receptor, the mean total
+    # recurrent weight that a neuron receives, and its relative error with respect to the reference.
+    # With the stratified sampling the errors only come from the sampling noise of the connections, and
+    # they shrink as n_neurons grows; the uniform sampling underestimates all of them by the sampling fraction
+    def _mean_input(_network):
+        n_nodes = _network['n_nodes']
+        n_receptors = _network['synapses']['dense_shape'][0] // n_nodes
+        total = np.bincount(_network['synapses']['indices'][:, 0], weights=_network['synapses']['weights'],
+                            minlength=n_nodes * n_receptors).reshape((n_nodes, n_receptors))
+        n_types = _network['node_params']['V_th'].shape[0]
+        sums = np.zeros((n_types, n_receptors))
+        np.add.at(sums, _network['node_type_ids'], total)
+        counts = np.bincount(_network['node_type_ids'], minlength=n_types)
+        return sums / np.maximum(counts, 1)[:, None], counts
+
+    mean_input, counts = _mean_input(network)
+    reference_input, _ = _mean_input(reference_network)
+    # only the node types present in the sampled network and the receptors with some input are compared
+    valid = (counts[:, None] > 0) & (np.abs(reference_input) > 0)
+    relative_error = np.where(valid, mean_input / np.where(valid, reference_input, 1.) - 1, np.nan)
+    report = dict(mean_input=mean_input, reference_input=reference_input, relative_error=relative_error,
+                  median_abs_relative_error=np.nanmedian(np.abs(relative_error)),
+                  max_abs_relative_error=np.nanmax(np.abs(relative_error)))
+    print(f'> Recurrent input per type and receptor: median relative error '
+          f'{report["median_abs_relative_error"]:.2%}, maximum {report["max_abs_relative_error"]:.2%}')
+    return report
+
+
+def permute_input_population(input_population, new_id, n_receptors):
+    # Renumber the targets of an input population (indices are target * n_receptors + receptor)
+    indices = input_population['indices']
+    new_indices = np.stack(
+        [new_id[indices[:, 0] // n_receptors] * n_receptors + indices[:, 0] % n_receptors, indices[:, 1]], -1)
+    new_indices, weights, delays = sort_indices(
+        new_indices, input_population['weights'], input_population['delays'])
+    new_input_population = dict(input_population)
+    new_input_population.update(indices=new_indices, weights=weights, delays=delays)
+    return new_input_population
+
+
+def permute_network(network, input_population, bkg_weights, order):
+    # Renumber the neurons so that new tf id i corresponds to the old tf id order[i].
+    # The inputs are not modified; new dictionaries are returned with the maps
+    # network['permutation'] (new id -> old id) and network['inverse_permutation'] (old id -> new id)
+    n_nodes = network['n_nodes']
+    order = np.asarray(order, np.int64)
+    new_id = np.zeros(n_nodes, np.int64)
+    new_id[order] = np.arange(n_nodes)
+    # the synapse indices encode the receptor type as target * n_receptors + receptor
+    n_receptors = network['synapses']['dense_shape'][0] // n_nodes
+    n_input_receptors = bkg_weights.shape[0] // n_nodes
+
+    indices = network['synapses']['indices']
+    new_indices = np.stack([new_id[indices[:, 0] // n_receptors] * n_receptors + indices[:, 0] % n_receptors,
+                            new_id[indices[:, 1]]], -1)
+    new_indices, weights, delays = sort_indices(
+        new_indices, network['synapses']['weights'], network['synapses']['delays'])
+
+    new_network = dict(network)
+    new_network.update(
+        x=network['x'][order], y=network['y'][order], z=network['z'][order],
+        node_params={k: v.copy() for k, v in network['node_params'].items()},
+        node_type_ids=network['node_type_ids'][order],
+        synapses=dict(indices=new_indices, weights=weights, delays=delays,
+                      dense_shape=network['synapses']['dense_shape']),
+        tf_id_to_bmtk_id=network['tf_id_to_bmtk_id'][order])
+    bmtk_id_to_tf_id = network['bmtk_id_to_tf_id'].copy()
+    bmtk_id_to_tf_id[new_network['tf_id_to_bmtk_id']] = np.arange(n_nodes)
+    new_network['bmtk_id_to_tf_id'] = bmtk_id_to_tf_id
+    if 'readout_neuron_ids' in network:
+        new_network['readout_neuron_ids'] = new_id[network['readout_neuron_ids']]
+    if 'l5e_neuron_sel' in network:
+        new_network['l5e_neuron_sel'] = network['l5e_neuron_sel'][order]
+    # compose with a previous permutation so that the maps always refer to the loaded order
+    previous_order = network.get('permutation', np.arange(n_nodes))
+    new_network['permutation'] = previous_order[order]
+    inverse_permutation = np.zeros(n_nodes, np.int64)
+    inverse_permutation[new_network['permutation']] = np.arange(n_nodes)
+    new_network['inverse_permutation'] = inverse_permutation
+
+    new_input_population = permute_input_population(input_population, new_id, n_input_receptors)
+    new_bkg_weights = bkg_weights.reshape((n_nodes, n_input_receptors))[order].reshape(-1)
+    return new_network, new_input_population, new_bkg_weights
+
+
+def sort_neurons_by_type(network, input_population, bkg_weights):
+    # Make the neurons of each node type contiguous (required by BillehColumn(per_type_params=True)
+    # to expand the per type parameters with a tf.repeat)
+    order = np.argsort(network['node_type_ids'], kind='stable')
+    return permute_network(network, input_population, bkg_weights, order)
+
+
+def neuron_ordering(network, method='type_space'):
+    # Orderings that place neurons sharing many synapses close in memory:
+    #   'type': node type (makes the types contiguous, see sort_neurons_by_type)
+    #   'space': depth (y) and then position inside the layer (x, z)
+    #   'type_space': node type and then space
+    #   'rcm': reverse Cuthill-McKee on the symmetrized connectivity, which reduces the bandwidth
+    #          of the recurrent matrix so that the spikes read by consecutive rows are close together
+    if method == 'type':
+        return np.argsort(network['node_type_ids'], kind='stable')
+    elif method == 'space':
+        return np.lexsort((network['z'], network['x'], network['y']))
+    elif method == 'type_space':
+        return np.lexsort((network['z'], network['x'], network['y'], network['node_type_ids']))
+    elif method == 'rcm':
+        n_nodes = network['n_nodes']
+        n_receptors = network['synapses']['dense_shape'][0] // n_nodes
+        indices = network['synapses']['indices']
+        adjacency = csr_matrix((np.ones(len(indices), np.int8), (indices[:, 0] // n_receptors, indices[:, 1])),
+                               shape=(n_nodes, n_nodes))
+        adjacency = (adjacency + adjacency.T).tocsr()
+        return np.asarray(reverse_cuthill_mckee(adjacency, symmetric_mode=True), np.int64)
+    else:
+        raise ValueError(f'Unknown neuron ordering {method}')
+
+
+def reorder_network(network, input_population, bkg_weights, method='type_space'):
+    order = neuron_ordering(network, method=method)
+    return permute_network(network, input_population, bkg_weights, order)
+
+
+def restore_neuron_order(data, network, axis=-1):
+    # Put the neuron axis of data (e.g. spikes or voltages of a reordered network) back in the loaded order
+    if 'inverse_permutation' not in network:
+        return data
+    return np.take(data, network['inverse_permutation'], axis=axis)
+
+
+def original_neuron_ids(ids, network):
+    # tf ids of a reordered network -> tf ids in the loaded order
+    if 'permutation' not in network:
+        return ids
+    return network['permutation'][ids]
+
+
+def prune_synapses(synapses, n_nodes, n_receptors, abs_threshold=None, rel_threshold=None):
+    # Drop the synapses with |weight| < abs_threshold or with |weight| < rel_threshold times the
+    # total absolute input weight of their target neuron. Weights like 1e-20 cost as much in the
+    # sparse matmul as any other synapse but have no effect on the dynamics
+    indices, weights = synapses['indices'], synapses['weights']
+    targets = indices[:, 0] // n_receptors
+    abs_weights = np.abs(weights)
+    keep = np.ones(len(weights), np.bool_)
+    if abs_threshold is not None:
+        keep &= abs_weights >= abs_threshold
+    total_abs_input = np.bincount(targets, weights=abs_weights, minlength=n_nodes)
+    if rel_threshold is not None:
+        keep &= abs_weights >= rel_threshold * total_abs_input[targets]
+
+    # Change in the total (signed) input weight of every neuron, relative to its total absolute input
+    removed_input = np.bincount(targets[~keep], weights=weights[~keep], minlength=n_nodes)
+    relative_change = np.abs(removed_input) / np.maximum(total_abs_input, 1e-30)
+    report = dict(nnz=len(weights), nnz_removed=int(np.sum(~keep)),
+                  fraction_removed=np.sum(~keep) / max(len(weights), 1),
+                  max_input_change=np.max(np.abs(removed_input)) if n_nodes > 0 else 0.,
+                  max_relative_input_change=np.max(relative_change) if n_nodes > 0 else 0.,
+                  mean_relative_input_change=np.mean(relative_change) if n_nodes > 0 else 0.)
+
+    pruned = dict(synapses)
+    pruned.update(indices=indices[keep], weights=weights[keep], delays=synapses['delays'][keep])
+    return pruned, report
+
+
+def prune_network(network, input_population, bkg_weights, abs_threshold=None, rel_threshold=None):
+    # Prune the recurrent and the input synapses. The inputs are not modified
+    n_nodes = network['n_nodes']
+    n_receptors = network['synapses']['dense_shape'][0] // n_nodes
+    synapses, recurrent_report = prune_synapses(
+        network['synapses'], n_nodes, n_receptors, abs_threshold=abs_threshold, rel_threshold=rel_threshold)
+    new_network = dict(network)
+    new_network['synapses'] = synapses
+    new_network['n_edges'] = len(synapses['weights'])
+    # the input indices encode the receptor of the target as n_input_receptors * target + receptor,
+    # with the layout of bkg_weights (as in permute_network)
+    n_input_receptors = bkg_weights.shape[0] // n_nodes
+    new_input_population, input_report = prune_synapses(
+        input_population, n_nodes, n_input_receptors, abs_threshold=abs_threshold, rel_threshold=rel_threshold)
+    for name, report in (('Recurrent', recurrent_report), ('Input', input_report)):
+        print(f'> {name} synapses pruned: {report["nnz_removed"]} of {report["nnz"]} '
+              f'({report["fraction_removed"]:.2%}), maximum relative change of the input per neuron: '
+              f'{report["max_relative_input_change"]:.2e}')
+    return new_network, new_input_population, dict(recurrent=recurrent_report, input=input_report)
+
+
 # Here we load the 17400 neurons that act as input in the model
 def load_input(path='GLIF_network/input_dat.pkl',
                start=0,
@@ -403,11 +583,12 @@ def reduce_input_population(input_population, new_n_input, seed=3000):
 
 
 def load_billeh(n_input, n_neurons, core_only, data_dir, seed=3000, connected_selection=False, n_output=2,
-                neurons_per_output=16):
+                neurons_per_output=16, neuron_order=None, prune_abs_threshold=None, prune_rel_threshold=None,
+                stratified=False):
     network = load_network(
         path=os.path.join(data_dir, 'network_dat.pkl'),
         h5_path=os.path.join(data_dir, 'network/v1_nodes.h5'), core_only=core_only, n_neurons=n_neurons,
-        seed=seed, connected_selection=connected_selection)
+        seed=seed, connected_selection=connected_selection, stratified=stratified)
     inputs = load_input(
         start=1000, duration=1000, dt=1, path=os.path.join(data_dir, 'input_dat.pkl'),
         bmtk_id_to_tf_id=network['bmtk_id_to_tf_id'])
@@ -446,17 +627,34 @@ def load_billeh(n_input, n_neurons, core_only, data_dir, seed=3000, connected_se
     if n_input != 17400:
         input_population = reduce_input_population(
             input_population, n_input, seed=seed)
+    if prune_abs_threshold is not None or prune_rel_threshold is not None:
+        network, input_population, pruning_report = prune_network(
+            network, input_population, bkg_weights, abs_threshold=prune_abs_threshold, rel_threshold=prune_rel_threshold)
+        network['pruning_report'] = pruning_report
+    if neuron_order is not None:
+        # Locality aware renumbering of the neurons (see neuron_ordering)
+        network, input_population, bkg_weights = reorder_network(
+            network, input_population, bkg_weights, method=neuron_order)
+        bkg = permute_input_population(
+            bkg, network['inverse_permutation'], len(bkg_weights) // network['n_nodes'])
     # return input_population, network, bkg_weights
     return input_population, network, bkg, bkg_weights
 
 
 # If the model already exist we can load it, or if it does not just save it for future occasions
 def cached_load_billeh(n_input, n_neurons, core_only, data_dir, seed=3000, connected_selection=False, n_output=2,
-                       neurons_per_output=16):
+                       neurons_per_output=16, neuron_order=None, prune_abs_threshold=None,
+                       prune_rel_threshold=None, stratified=False):
     store = False
     input_population, network, bkg, bkg_weights = None, None, None, None
     flag_str = f'in{n_input}_rec{n_neurons}_s{seed}_c{core_only}_con{connected_selection}'
     flag_str += f'_out{n_output}_nper{neurons_per_output}'
+    if neuron_order is not None:
+        flag_str += f'_order{neuron_order}'
+    if prune_abs_threshold is not None or prune_rel_threshold is not None:
+        flag_str += f'_prune{prune_abs_threshold}-{prune_rel_threshold}'
+    if stratified:
+        flag_str += '_stratified'
     file_dir = os.path.split(__file__)[0]
     cache_path = os.path.join(
         file_dir, f'.cache/billeh_network_{flag_str}.pkl')
@@ -469,13 +667,19 @@ def cached_load_billeh(n_input, n_neurons, core_only, data_dir, seed=3000, conne
         except Exception as e:
             print(e)
             store = True
+        if network is not None and 'rheobase' not in network['node_params']:
+            # cached before load_network computed the rheobase, the entry is updated
+            network['node_params']['rheobase'] = rheobase(network['node_params']).astype(np.float32)
+            store = True
     else:
         store = True
     if input_population is None or network is None or bkg is None or bkg_weights is None:
         input_population, network, bkg, bkg_weights = load_billeh(
             n_input, n_neurons, core_only, data_dir, seed,
             connected_selection=connected_selection, n_output=n_output,
-            neurons_per_output=neurons_per_output)
+            neurons_per_output=neurons_per_output, neuron_order=neuron_order,
+            prune_abs_threshold=prune_abs_threshold, prune_rel_threshold=prune_rel_threshold,
+            stratified=stratified)
     if store:
         os.makedirs(os.path.join(file_dir, '.cache'), exist_ok=True)
         with open(cache_path, 'wb') as f:
@@ -0,0 +1,92 @@
+import numpy as np
+import tensorflow as tf
+
+import benchmarks
+import synthetic_network
+
+# Resident memory of the Python process with TensorFlow imported and the model built, before any simulation
+RUNTIME_OVERHEAD_MB = 700.
+
+
+def _n_receptors(network):
+    return network['synapses']['dense_shape'][0] // network['n_nodes']
+
+
+def estimate_memory(network, input_population, batch_size, seq_len, max_delay=5, training=False,
+                    n_recorded_outputs=3, chunk_len=None, dtype_size=4, optimizer_slots=2,
+                    runtime_overhead_mb=RUNTIME_OVERHEAD_MB):
+    # Expected peak memory (MB) of simulating or training a create_model/ChunkedSimulator configuration,
+    # split in its components:
+    #  - synapses: the network dicts on the host and the indices, values and signs of the sparse weights
+    #  - state: the RNN state of the batch (delay buffer, voltage, refractoriness, ascs and pscs)
+    #  - inputs: LGN spikes, their current (n_receptors per neuron) and the state input of create_model
+    #  - outputs: the per step outputs (spikes, voltages and currents, n_recorded_outputs of them)
+    #  - backprop: per step tensors kept by the RNN for the backward pass, the transient (n_synapses, batch)
+    #    products of the gradient of the sparse matmuls, and the weight gradients with optimizer slots
+    # chunk_len (inference only) is the length of the chunks of ChunkedSimulator, seq_len by default
+    n = network['n_nodes']
+    n_receptors = _n_receptors(network)
+    n_synapses = len(network['synapses']['indices'])
+    n_input_synapses = len(input_population['indices'])
+    n_inputs = input_population['n_inputs']
+    max_delay = int(np.round(np.min([np.max(network['synapses']['delays']), max_delay])))
+    steps = seq_len if training or chunk_len is None else min(chunk_len, seq_len)
+
+    # host copy (int64 indices, float32 weights and delays) + cell variables (indices, values, signs)
+    bytes_per_synapse = (16 + 4 + 4) + (16 + 4 + 1)
+    synapses = (n_synapses + n_input_synapses) * bytes_per_synapse + n * n_receptors * 4
+    state_per_trial = n * max_delay + 4 * n + 2 * n_receptors * n
+    state = 2 * batch_size * state_per_trial * dtype_size
+    inputs = batch_size * steps * (n_inputs * 4 + n_receptors * n * (4 + dtype_size) + n * dtype_size)
+    outputs = batch_size * steps * n * n_recorded_outputs * dtype_size
+    backprop = 0
+    if training:
+        # state and the intermediates of the neuron update of every step
+        saved_per_step = state_per_trial + n * max_delay + 3 * n_receptors * n + 10 * n
+        backprop = batch_size * seq_len * saved_per_step * dtype_size
+        backprop += 2 * max(n_synapses, n_input_synapses) * batch_size * 4
+        backprop += (n_synapses + n_input_synapses) * 4 * (1 + optimizer_slots)
+
+    components = dict(synapses=synapses, state=state, inputs=inputs, outputs=outputs, backprop=backprop)
+    estimate = {k: v / 2 ** 20 for k, v in components.items()}
+    estimate['runtime'] = runtime_overhead_mb
+    estimate['total'] = sum(estimate.values())
+    return estimate
+
+
+def plan_run(network, input_population, budget_mb, seq_len, max_delay=5, training=False,
+             batch_sizes=(1, 2, 4, 8, 16, 32, 64, 128), chunk_lens=(2000, 1000, 500, 250, 100, 50),
+             **estimate_kwargs):
+    # Largest batch size (and then the longest time chunk, only for inference) whose estimate fits in
+    # budget_mb. Returns the batch size, the chunk length and the estimate, or raises ValueError
+    candidate_chunks = [seq_len] if training else [seq_len] + [a for a in chunk_lens if a < seq_len]
+    for batch_size in sorted(batch_sizes, reverse=True):
+        for chunk_len in candidate_chunks:
+            estimate = estimate_memory(network, input_population, batch_size, seq_len, max_delay=max_delay,
+                                       training=training, chunk_len=chunk_len, **estimate_kwargs)
+            if estimate['total'] <= budget_mb:
+                print(f'> Planned batch size {batch_size}, chunk length {chunk_len}: '
+                      f'{estimate["total"]:.0f} MB of {budget_mb:.0f} MB')
+                return batch_size, chunk_len, estimate
+    raise ValueError(f'No configuration fits in {budget_mb} MB')
+
+
+def validate_estimates(cases, seed=3000):
+    # Estimated against measured peak RSS for cases of benchmarks.benchmark_scaling (dicts with n_neurons,
+    # batch_size, seq_len, max_delay, dtype, connection_probability, mode and optionally n_input), each
+    # measured in a fresh process
+    results = []
+    for case in cases:
+        case = dict(case)
+        n_input = case.pop('n_input', 1000)
+        measured = benchmarks.run_isolated(benchmarks.scaling_case, n_input=n_input, seed=seed, **case)
+        input_population, network, _, _ = synthetic_network.make_synthetic_billeh(
+            n_neurons=case['n_neurons'], n_input=n_input, connection_probability=case['connection_probability'],
+            seed=seed)
+        estimate = estimate_memory(network, input_population, case['batch_size'], case['seq_len'],
+                                   max_delay=case['max_delay'], training=case['mode'] == 'train',
+                                   dtype_size=tf.as_dtype(case['dtype']).size)
+        results.append(dict(case, estimated_mb=estimate['total'], measured_mb=measured['peak_rss_mb'],
+                            relative_error=estimate['total'] / measured['peak_rss_mb'] - 1))
+        print(f'> {case}: estimated {estimate["total"]:.0f} MB, measured {measured["peak_rss_mb"]:.0f} MB')
+    return results
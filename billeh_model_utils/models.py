@@ -132,8 +132,63 @@ def exp_convolve(tensor, decay=.8, reverse=False, initializer=None, axis=0):
     return filtered
 
 
+def _exp_convolve_chunk(chunk, decay, carry):
+    # Hillis-Steele prefix scan of acc_t = decay * acc_{t-1} + x_t inside a chunk of static length.
+    # After the step with shift k every entry holds the sum of the last 2k inputs, so the
+    # recurrence is solved in log2(chunk length) vectorized steps
+    n_steps = chunk.shape[0]
+    filtered = chunk
+    shift = 1
+    while shift < n_steps:
+        shifted = tf.concat((tf.zeros_like(filtered[:shift]), filtered[:-shift]), 0)
+        filtered = filtered + tf.pow(decay, shift) * shifted
+        shift *= 2
+    # contribution of the value carried from the previous chunk
+    steps = tf.reshape(tf.range(1, n_steps + 1, dtype=chunk.dtype),
+                       (-1,) + (1,) * (len(chunk.shape) - 1))
+    return filtered + tf.pow(decay, steps) * carry[None]
+
+
+def parallel_exp_convolve(tensor, decay=.8, reverse=False, initializer=None, axis=0, chunk_size=128):
+    # Same result as exp_convolve, but computed with a log-depth parallel prefix scan. The time axis
+    # is split in chunks of chunk_size steps that are scanned in parallel, and only the last value of
+    # each chunk is carried sequentially, so the temporaries never exceed the size of one chunk
+    rank = len(tensor.get_shape())
+    perm = np.arange(rank)
+    perm[0], perm[axis] = perm[axis], perm[0]
+    tensor = tf.transpose(tensor, perm)
+    if reverse:
+        tensor = tf.reverse(tensor, [0])
+
+    if initializer is None:
+        initializer = tf.zeros_like(tensor[0])
+    decay = tf.cast(decay, tensor.dtype)
+    if chunk_size is None:
+        chunk_size = tensor.shape[0]
+
+    n_steps = tf.shape(tensor)[0]
+    n_chunks = (n_steps + chunk_size - 1) // chunk_size
+    # zeros appended at the end do not modify the previous values of the recurrence
+    padding = [[0, n_chunks * chunk_size - n_steps]] + [[0, 0]] * (rank - 1)
+    chunks = tf.reshape(tf.pad(tensor, padding),
+                        tf.concat(([n_chunks, chunk_size], tf.shape(tensor)[1:]), 0))
+
+    def scan_fun(_acc, _chunk):
+        return _exp_convolve_chunk(_chunk, decay, _acc[-1])
+
+    initial_chunk = tf.concat((tf.zeros_like(chunks[0, :-1]), initializer[None]), 0)
+    filtered = tf.scan(scan_fun, chunks, initializer=initial_chunk)
+    filtered = tf.reshape(filtered, tf.concat(([-1], tf.shape(tensor)[1:]), 0))[:n_steps]
+
+    if reverse:
+        filtered = tf.reverse(filtered, [0])
+    filtered = tf.transpose(filtered, perm)
+    return filtered
+
+
 class SparseLayer(tf.keras.layers.Layer):
-    def __init__(self, indices, weights, dense_shape, bkg_weights, lr_scale=1., dtype=tf.float32, **kwargs):
+    def __init__(self, indices, weights, dense_shape, bkg_weights, lr_scale=1., dtype=tf.float32,
+                 noise_generator=None, **kwargs):
         super().__init__(**kwargs)
         self._indices = indices
         self._weights = weights
@@ -143,6 +198,7 @@ class SparseLayer(tf.keras.layers.Layer):
         self._dtype = dtype        
         self._bkg_weights = bkg_weights
         self._lr_scale = lr_scale
+        self._noise_generator = noise_generator
 
     def call(self, inp):
         tf_shp = tf.unstack(tf.shape(inp))
@@ -154,48 +210,51 @@ class SparseLayer(tf.keras.layers.Layer):
         sparse_w_in = tf.sparse.SparseTensor(
             self._indices, self._weights, self._dense_shape)
         # print(sparse_w_in.shape) # (923696, 17400)
-        inp = tf.reshape(inp, (shp[0] * shp[1], shp[2]))
-        # print(inp.shape) #(2500, 17400)
-        # print(shp)#[1, 2500, 17400]
-        # print(self._weights.shape) #(3506881,)
-        # print(self._max_batch) #612
-        if shp[0] * shp[1] < self._max_batch:
-            input_current = tf.sparse.sparse_dense_matmul(
-                sparse_w_in, tf.cast(inp, tf.float32), adjoint_b=True)
-            input_current = tf.transpose(input_current)
-            input_current = tf.cast(input_current, self._dtype)
-        else:
-            _batch_size = shp[0] * shp[1] #2500
-            _n_iter = tf.ones((), tf.int32)
-            # while _batch_size > self._max_batch:
-            for _i in tf.range(int(np.log(self._max_batch) * 2)): #12
-                _sel = tf.greater(_batch_size, self._max_batch) #True
-                _batch_size = tf.where(_sel, tf.cast(
-                    _batch_size / 2, tf.int32), _batch_size)
-                # _n_iter = tf.where(_sel, _n_iter + 1, _n_iter)
-                _n_iter = tf.where(_sel, _n_iter * 2, _n_iter) # creo que esto es lo correcto
-
-            # _batch_size, _n_iter = 312, 4
-            results = tf.TensorArray(self._dtype, size=_n_iter)
-            for _i in tf.range(_n_iter):
-                partial_input_current = tf.sparse.sparse_dense_matmul(
-                    sparse_w_in, tf.cast(inp[_i * _batch_size:(_i + 1) * _batch_size], tf.float32), adjoint_b=True)
-                partial_input_current = tf.cast(
-                    tf.transpose(partial_input_current), self._dtype)
-                print(_i, partial_input_current.shape)
-                results = results.write(_i, partial_input_current)
-                _i += 1
-            input_current = results.stack()
-
-        rest_of_brain = tf.reduce_sum(tf.cast(
-            tf.random.uniform((shp[0], shp[1], 10)) < .1, self._compute_dtype), -1)
-        noise_input = tf.cast(
-            self._bkg_weights[None, None], self._compute_dtype) * rest_of_brain[..., None] / 10.
+        n_rows = shp[0] * shp[1]
+        inp = tf.reshape(inp, (n_rows, shp[2]))
+        # The product is computed in blocks of at most max_batch rows. The number of blocks is a
+        # tensor, so the graph is the same for every batch size and sequence length
+        _n_iter = tf.maximum((n_rows + self._max_batch - 1) // self._max_batch, 1)
+        results = tf.TensorArray(self._dtype, size=_n_iter, infer_shape=False,
+                                 element_shape=tf.TensorShape((None, self._dense_shape[0])))
+        for _i in tf.range(_n_iter):
+            partial_input_current = tf.sparse.sparse_dense_matmul(
+                sparse_w_in, tf.cast(inp[_i * self._max_batch:(_i + 1) * self._max_batch], tf.float32),
+                adjoint_b=True)
+            partial_input_current = tf.cast(
+                tf.transpose(partial_input_current), self._dtype)
+            results = results.write(_i, partial_input_current)
+        input_current = results.concat()
+
+        noise_input = background_noise(
+            self._bkg_weights, shp[0], shp[1], self._compute_dtype, self._noise_generator)
         input_current = tf.reshape(
             input_current, (shp[0], shp[1], -1)) + noise_input
         return input_current
 
 
+def background_noise(bkg_weights, batch_size, seq_len, dtype, generator=None):
+    # Current from the rest of the brain: 10 background sources firing with probability .1 per step.
+    # The draws come from generator (a tf.random.Generator) if given, else from the global seed
+    uniform = tf.random.uniform if generator is None else generator.uniform
+    rest_of_brain = tf.reduce_sum(tf.cast(
+        uniform((batch_size, seq_len, 10)) < .1, dtype), -1)
+    return tf.cast(bkg_weights[None, None], dtype) * rest_of_brain[..., None] / 10.
+
+
+class BackgroundNoiseLayer(tf.keras.layers.Layer):
+    # Only the stochastic background current of SparseLayer, for inputs whose deterministic LGN current
+    # is precomputed (see input_cache). inp is the LGN current, only its batch size and length are used
+    def __init__(self, bkg_weights, noise_generator=None, **kwargs):
+        super().__init__(**kwargs)
+        self._bkg_weights = bkg_weights
+        self._noise_generator = noise_generator
+
+    def call(self, inp):
+        shp = tf.shape(inp)
+        return background_noise(self._bkg_weights, shp[0], shp[1], self._compute_dtype, self._noise_generator)
+
+
 class SignedConstraint(tf.keras.constraints.Constraint):
     def __init__(self, positive):
         self._positive = positive
@@ -227,29 +286,122 @@ class StiffRegularizer(tf.keras.regularizers.Regularizer):
         return self._strength * tf.reduce_sum(tf.square(x - self._initial_value))
 
 
+class Probe:
+    # Recording probe of BillehColumn: the cell only emits the variable ('v', 'current' or 'asc')
+    # of neuron_ids (None for all of them). decimation is applied when the outputs leave the
+    # simulation (see recording.ProbeRecorder)
+    def __init__(self, variable, neuron_ids=None, decimation=1, name=None):
+        if variable not in ('v', 'current', 'asc'):
+            raise ValueError(f'Unknown probe variable {variable}')
+        self.variable = variable
+        self.neuron_ids = None if neuron_ids is None else np.asarray(neuron_ids, np.int64)
+        self.decimation = decimation
+        self.name = variable if name is None else name
+
+
+def _read_only(_a):
+    _a = np.asarray(_a).view()
+    _a.flags.writeable = False
+    return _a
+
+
+def preprocess_column(network, input_population, bkg_weights, dt=1., max_delay=5):
+    # NumPy preparation of everything BillehColumn needs from the network: normalized neuron parameters
+    # (per node type), scaled weights, delay-expanded recurrent indices and sign masks. The inputs are
+    # left unchanged and the returned arrays are read-only, so the result can be shared between cells
+    # and stored on disk (see column_cache)
+    node_params = network['node_params']
+    # Rescale the voltages to have them near 0, as we wanted the effective step size
+    # for the weights to be normalized when learning (weights are scaled similarly)
+    voltage_scale = node_params['V_th'] - node_params['E_L']
+    voltage_offset = node_params['E_L']
+    node_type_ids = network['node_type_ids']
+    n_receptors = node_params['tau_syn'].shape[1] # we have 4 receptors (soma, dendrites, etc) for each neuron
+    n_neurons = network['n_nodes']
+    # number of presynaptic neurons (it only differs from n_neurons for a partition of the network)
+    n_sources = network['synapses']['dense_shape'][1]
+
+    tau = node_params['C_m'] / node_params['g'] # determine the membrane time decay constant
+    decay = np.exp(-dt / tau)
+    current_factor = 1 / node_params['C_m'] * (1 - decay) * tau
+
+    # synapses: target_ids, source_ids, weights, delays
+    # this are the axonal delays
+    requested_max_delay = max_delay
+    max_delay = int(np.round(np.min([np.max(network['synapses']['delays']), max_delay])))
+
+    indices, weights, dense_shape = \
+        network['synapses']['indices'], network['synapses']['weights'], network['synapses']['dense_shape']
+    weights = weights / voltage_scale[node_type_ids[indices[:, 0] // n_receptors]]  # scale down the weights
+    delays = np.round(np.clip(network['synapses']['delays'], dt, max_delay) / dt).astype(np.int32)
+    # Notice that in dense_shape, the first column (presynaptic neuron) has size receptors*n_neurons
+    # and the second column (postsynaptic neuron) has size max_delay*n_neurons
+    dense_shape = dense_shape[0], max_delay * dense_shape[1]
+    recurrent_indices = np.stack((indices[:, 0], indices[:, 1] + n_sources * (delays - 1)), -1)
+
+    input_indices = input_population['indices']
+    input_weights = input_population['weights'].astype(np.float32)
+    input_weights = input_weights / voltage_scale[node_type_ids[input_indices[:, 0] // n_receptors]]
+    input_dense_shape = (n_receptors * n_neurons, input_population['n_inputs'])
+
+    arrays = dict(
+        node_type_ids=node_type_ids,
+        v_reset=(node_params['V_reset'] - voltage_offset) / voltage_scale,
+        v_th=(node_params['V_th'] - voltage_offset) / voltage_scale,
+        e_l=(node_params['E_L'] - voltage_offset) / voltage_scale,
+        asc_amps=node_params['asc_amps'] / voltage_scale[..., None],   # asc_amps has shape (111, 2)
+        t_ref=node_params['t_ref'], k=node_params['k'], g=node_params['g'],
+        decay=decay, current_factor=current_factor,
+        syn_decay=np.exp(-dt / np.array(node_params['tau_syn'])),
+        psc_initial=np.e / np.array(node_params['tau_syn']),
+        voltage_scale=voltage_scale, voltage_offset=voltage_offset,
+        recurrent_indices=recurrent_indices, recurrent_weights=weights.astype(np.float32),
+        input_indices=input_indices, input_weights=input_weights,
+        bkg_weights=bkg_weights / np.repeat(voltage_scale[node_type_ids], n_receptors))
+    preprocessed = {name: _read_only(value) for name, value in arrays.items()}
+    # max_delay is the length of the delay buffer, shorter than requested_max_delay when all the
+    # synaptic delays are
+    preprocessed.update(
+        dt=dt, max_delay=max_delay, requested_max_delay=requested_max_delay, n_neurons=n_neurons,
+        n_receptors=n_receptors, n_sources=n_sources,
+        recurrent_dense_shape=dense_shape, input_dense_shape=input_dense_shape)
+    return preprocessed
+
+
 class BillehColumn(tf.keras.layers.Layer):
     def __init__(self, network, input_population, bkg_weights,
                  dt=1., gauss_std=.5, dampening_factor=.3, recurrent_dampening_factor=.4,
                  input_weight_scale=1., recurrent_weight_scale=1.,
                  lr_scale=1., spike_gradient=False, max_delay=5, pseudo_gauss=False,
-                 train_recurrent=True, train_input=True, hard_reset=True):
+                 train_recurrent=True, train_input=True, hard_reset=True, per_type_params=False,
+                 probes=None, accumulate_statistics=False, preprocessed=None):
+        # preprocessed (the result of preprocess_column, e.g. loaded from column_cache) replaces
+        # network, input_population and bkg_weights (which can then be None). It must have been built
+        # with the same dt and max_delay
         super().__init__()
-        self._params = network['node_params']
-        
-        # Rescale the voltages to have them near 0, as we wanted the effective step size 
-        # for the weights to be normalized when learning (weights are scaled similarly)
-        voltage_scale = self._params['V_th'] - self._params['E_L']
-        voltage_offset = self._params['E_L']
-        self._params['V_th'] = (self._params['V_th'] -
-                                voltage_offset) / voltage_scale
-        self._params['E_L'] = (self._params['E_L'] -
-                               voltage_offset) / voltage_scale
-        self._params['V_reset'] = (
-            self._params['V_reset'] - voltage_offset) / voltage_scale
-        self._params['asc_amps'] = self._params['asc_amps'] / \
-            voltage_scale[..., None]   # _params['asc_amps'] has shape (111, 2)
-
-        self._node_type_ids = network['node_type_ids']
+        if preprocessed is None:
+            preprocessed = preprocess_column(network, input_population, bkg_weights, dt=dt, max_delay=max_delay)
+        elif preprocessed['dt'] != dt or preprocessed['requested_max_delay'] != max_delay:
+            raise ValueError(
+                f'The column was preprocessed with dt={preprocessed["dt"]} and '
+                f'max_delay={preprocessed["requested_max_delay"]}, not dt={dt} and max_delay={max_delay}')
+        # only the per type voltage normalization is kept, the synapse arrays are copied into the variables
+        self.type_voltage_scale = preprocessed['voltage_scale']
+        self.type_voltage_offset = preprocessed['voltage_offset']
+        dt = preprocessed['dt']
+
+        self._node_type_ids = preprocessed['node_type_ids']
+        # With per_type_params the neuron parameters are stored once per node type (111 values instead
+        # of one per neuron) and expanded to the neurons when the cell runs (once per sequence with
+        # ColumnRNN). If the neurons of each type are contiguous (see load_sparse.sort_neurons_by_type)
+        # the expansion is a tf.repeat instead of a gather. Only the stored variables shrink: the steps
+        # read expanded per neuron tensors, so the per step traffic and the memory during a simulation
+        # are those of the per neuron storage (see benchmarks.benchmark_per_type_params)
+        self._per_type_params = per_type_params
+        self._expanded_params = None
+        self._type_contiguous = bool(np.all(np.diff(self._node_type_ids) >= 0))
+        self._type_counts = np.bincount(
+            self._node_type_ids, minlength=preprocessed['v_th'].shape[0]).astype(np.int32)
         self._dt = dt
         self._recurrent_dampening = recurrent_dampening_factor
         self._pseudo_gauss = pseudo_gauss
@@ -260,23 +412,22 @@ class BillehColumn(tf.keras.layers.Layer):
         
         self._hard_reset = hard_reset
 
-        n_receptors = network['node_params']['tau_syn'].shape[1] # we have 4 receptors (soma, dendrites, etc) for each neuron
+        # If probes is given (a list of Probe, possibly empty) the cell outputs the spikes followed by
+        # the probed slices instead of the full voltages and currents
+        self._probes = probes
+
+        # With accumulate_statistics the state carries running sums of the statistics needed by the
+        # regularizers (see accumulated_statistics), so that they do not need the full sequences
+        self._accumulate_statistics = accumulate_statistics
+
+        n_receptors = preprocessed['n_receptors']
         self._n_receptors = n_receptors
-        self._n_neurons = network['n_nodes']
+        self._n_neurons = preprocessed['n_neurons']
+        self._n_sources = preprocessed['n_sources']
         self._dampening_factor = tf.cast(dampening_factor, self._compute_dtype)
         self._gauss_std = tf.cast(gauss_std, self._compute_dtype)
 
-        tau = self._params['C_m'] / self._params['g'] # determine the membrane time decay constant
-        self._decay = np.exp(-dt / tau)
-        self._current_factor = 1 / \
-            self._params['C_m'] * (1 - self._decay) * tau
-        self._syn_decay = np.exp(-dt / np.array(self._params['tau_syn']))
-        self._psc_initial = np.e / np.array(self._params['tau_syn'])
-
-        # synapses: target_ids, source_ids, weights, delays
-        # this are the axonal delays
-        self.max_delay = int(
-            np.round(np.min([np.max(network['synapses']['delays']), max_delay])))
+        self.max_delay = preprocessed['max_delay']
 
         self.state_size = (
             self._n_neurons * self.max_delay,                # z buffer
@@ -287,15 +438,27 @@ class BillehColumn(tf.keras.layers.Layer):
             n_receptors * self._n_neurons,                   # psc rise
             n_receptors * self._n_neurons,                   # psc
         )
+        if accumulate_statistics:
+            self.state_size = self.state_size + (
+                1,                                           # number of steps
+                self._n_neurons,                             # spike counts
+                1,                                           # voltage loss sum
+            )
+
+        if per_type_params:
+            def _store(_v):
+                return _v
+        else:
+            _store = self._gather
 
         def _f(_v, trainable=False):
-            return tf.Variable(tf.cast(self._gather(_v), self._compute_dtype), trainable=trainable)
+            return tf.Variable(tf.cast(_store(_v), self._compute_dtype), trainable=trainable)
 
         def inv_sigmoid(_x):
             return tf.math.log(_x / (1 - _x))
 
         def custom_val(_v, trainable=False):
-            _v = tf.Variable(tf.cast(inv_sigmoid(self._gather(
+            _v = tf.Variable(tf.cast(inv_sigmoid(_store(
                 _v)), self._compute_dtype), trainable=trainable)
 
             def _g():
@@ -303,49 +466,25 @@ class BillehColumn(tf.keras.layers.Layer):
 
             return _v, _g
 
-        self.v_reset = _f(self._params['V_reset'])
-        self.syn_decay = _f(self._syn_decay)
-        self.psc_initial = _f(self._psc_initial)
-        self.t_ref = _f(self._params['t_ref'])  # refractory time
-        # print(set(self._params['t_ref']))
-        self.asc_amps = _f(self._params['asc_amps'], trainable=False)
-        _k = self._params['k']
-        self.param_k, self.param_k_read = custom_val(_k, trainable=False)
-        self.v_th = _f(self._params['V_th'])
-        self.e_l = _f(self._params['E_L'])
-        self.param_g = _f(self._params['g'])
-        self.decay = _f(self._decay)
-        self.current_factor = _f(self._current_factor)
-        self.voltage_scale = _f(voltage_scale)
-        self.voltage_offset = _f(voltage_offset)
+        self.v_reset = _f(preprocessed['v_reset'])
+        self.syn_decay = _f(preprocessed['syn_decay'])
+        self.psc_initial = _f(preprocessed['psc_initial'])
+        self.t_ref = _f(preprocessed['t_ref'])  # refractory time
+        self.asc_amps = _f(preprocessed['asc_amps'], trainable=False)
+        self.param_k, self.param_k_read = custom_val(preprocessed['k'], trainable=False)
+        self.v_th = _f(preprocessed['v_th'])
+        self.e_l = _f(preprocessed['e_l'])
+        self.param_g = _f(preprocessed['g'])
+        self.decay = _f(preprocessed['decay'])
+        self.current_factor = _f(preprocessed['current_factor'])
+        self.voltage_scale = _f(preprocessed['voltage_scale'])
+        self.voltage_offset = _f(preprocessed['voltage_offset'])
         self.recurrent_weights = None
 
-        indices, weights, dense_shape = \
-            network['synapses']['indices'], network['synapses']['weights'], network['synapses']['dense_shape']
-        weights = weights / \
-            voltage_scale[self._node_type_ids[indices[:, 0] //
-                                             self._n_receptors]]  # scale down the weights
-
-        delays = np.round(np.clip(
-            network['synapses']['delays'], dt, self.max_delay) / dt).astype(np.int32)
-        dense_shape = dense_shape[0], self.max_delay * dense_shape[1] 
-        # Notice that in dense_shape, the first column (presynaptic neuron) has size receptors*n_neurons 
-        # and the second column (postsynaptic neuron) has size max_delay*n_neurons
-        
-        indices[:, 1] = indices[:, 1] + self._n_neurons * (delays - 1)
-        
-        
-        weights = weights.astype(np.float32)
-        print(f'> Recurrent synapses {len(indices)}')
-        input_weights = input_population['weights'].astype(np.float32)
-        input_indices = input_population['indices']
-        input_weights = input_weights / \
-            voltage_scale[self._node_type_ids[input_indices[:,
-                                                            0] // self._n_receptors]]
-        print(f'> Input synapses {len(input_indices)}')
-
-        input_dense_shape = (self._n_receptors *
-                             self._n_neurons, input_population['n_inputs'])
+        weights = preprocessed['recurrent_weights']
+        input_weights = preprocessed['input_weights']
+        print(f'> Recurrent synapses {len(weights)}')
+        print(f'> Input synapses {len(input_weights)}')
 
         self.recurrent_weight_positive = tf.Variable(
             weights >= 0., name='recurrent_weights_sign', trainable=False)
@@ -355,19 +494,17 @@ class BillehColumn(tf.keras.layers.Layer):
             weights * recurrent_weight_scale / lr_scale, name='sparse_recurrent_weights',
             constraint=SignedConstraint(self.recurrent_weight_positive),
             trainable=train_recurrent)
-        self.recurrent_indices = tf.Variable(indices, trainable=False)
-        self.recurrent_dense_shape = dense_shape
+        self.recurrent_indices = tf.Variable(preprocessed['recurrent_indices'], trainable=False)
+        self.recurrent_dense_shape = preprocessed['recurrent_dense_shape']
 
         self.input_weight_values = tf.Variable(
             input_weights * input_weight_scale / lr_scale, name='sparse_input_weights',
             constraint=SignedConstraint(self.input_weight_positive),
             trainable=train_input)
-        self.input_indices = tf.Variable(input_indices, trainable=False)
-        self.input_dense_shape = input_dense_shape
-        bkg_weights = bkg_weights / \
-            np.repeat(voltage_scale[self._node_type_ids], self._n_receptors)
+        self.input_indices = tf.Variable(preprocessed['input_indices'], trainable=False)
+        self.input_dense_shape = preprocessed['input_dense_shape']
         self.bkg_weights = tf.Variable(
-            bkg_weights * 10., name='rest_of_brain_weights', trainable=train_input)
+            preprocessed['bkg_weights'] * 10., name='rest_of_brain_weights', trainable=train_input)
 
     def compute_input_current(self, inp):
         tf_shp = tf.unstack(tf.shape(inp))
@@ -384,13 +521,13 @@ class BillehColumn(tf.keras.layers.Layer):
         input_current = tf.transpose(input_current)
 
         input_current = tf.reshape(
-            input_current, (shp[0], shp[1], 4 * self._n_neurons))
+            input_current, (shp[0], shp[1], self.input_dense_shape[0]))
         return input_current
 
     def zero_state(self, batch_size, dtype=tf.float32):
         # The neurons membrane voltage start the simulation at their reset value
         v0 = tf.ones((batch_size, self._n_neurons), dtype) * \
-                tf.cast(self.v_th * .0 + 1. * self.v_reset, dtype)
+                tf.cast(self.per_neuron(self.v_reset), dtype)
         z0_buf = tf.zeros(
             (batch_size, self._n_neurons * self.max_delay), dtype)
         r0 = tf.zeros((batch_size, self._n_neurons), dtype)
@@ -400,88 +537,120 @@ class BillehColumn(tf.keras.layers.Layer):
             (batch_size, self._n_neurons * self._n_receptors), dtype)
         psc0 = tf.zeros(
             (batch_size, self._n_neurons * self._n_receptors), dtype)
+        if self._accumulate_statistics:
+            n_steps0 = tf.zeros((batch_size, 1), dtype)
+            spike_counts0 = tf.zeros((batch_size, self._n_neurons), dtype)
+            voltage_loss0 = tf.zeros((batch_size, 1), dtype)
+            return z0_buf, v0, r0, asc_10, asc_20, psc_rise0, psc0, n_steps0, spike_counts0, voltage_loss0
         return z0_buf, v0, r0, asc_10, asc_20, psc_rise0, psc0
 
+    def accumulated_statistics(self, state):
+        # Statistics summed over the steps simulated since the zero state (accumulate_statistics=True):
+        # the number of steps, the spike count of every neuron and the voltage loss of
+        # VoltageRegularization summed over neurons and steps, all with shape (batch, ...)
+        n_steps, spike_counts, voltage_loss = state[7:10]
+        return dict(n_steps=n_steps, spike_counts=spike_counts, voltage_loss=voltage_loss)
+
     def _gather(self, prop):
         return tf.gather(prop, self._node_type_ids)
 
-    def call(self, inputs, state, constants=None):
-        batch_size = inputs.shape[0]
-        if batch_size is None:
-            batch_size = tf.shape(inputs)[0]
-        external_current = inputs
-        if self._spike_gradient:
-            state_input = tf.zeros((1,))
+    def _expand(self, prop):
+        if self._type_contiguous:
+            return tf.repeat(prop, self._type_counts, axis=0)
+        return self._gather(prop)
+
+    def per_neuron(self, prop):
+        # Per neuron values of a parameter of the cell, whatever the storage mode is
+        if self._per_type_params:
+            return self._expand(prop)
+        return prop
+
+    def neuron_params(self):
+        params = dict(
+            v_reset=self.v_reset, t_ref=self.t_ref, v_th=self.v_th, e_l=self.e_l, param_g=self.param_g,
+            decay=self.decay, current_factor=self.current_factor, voltage_scale=self.voltage_scale,
+            voltage_offset=self.voltage_offset, syn_decay=self.syn_decay, psc_initial=self.psc_initial,
+            asc_amps=self.asc_amps, k=self.param_k_read())
+        if not self._per_type_params:
+            return params
+        # All the per type parameters are stacked in a single (n_types, n_columns) table so that
+        # they are expanded to the neurons with only one op (once per sequence with ColumnRNN)
+        names = list(params.keys())
+        columns = [params[name] if len(params[name].shape) == 2 else params[name][:, None] for name in names]
+        widths = [c.shape[1] for c in columns]
+        expanded = tf.split(self._expand(tf.concat(columns, 1)), widths, axis=1)
+        return {name: (e if len(params[name].shape) == 2 else e[:, 0]) for name, e in zip(names, expanded)}
+
+    def step_params(self):
+        # Neuron parameters used by a step: expanded once per sequence by ColumnRNN, otherwise in the step
+        if self._expanded_params is not None:
+            return self._expanded_params
+        return self.neuron_params()
+
+    def _probe_output(self, probe, new_v, input_current, new_asc_1, new_asc_2, params):
+        def _select(_x):
+            if probe.neuron_ids is None:
+                return _x
+            return tf.gather(_x, probe.neuron_ids, axis=-1)
+
+        if probe.variable == 'v':
+            return _select(new_v) * _select(params['voltage_scale']) + _select(params['voltage_offset'])
+        elif probe.variable == 'current':
+            return _select(input_current) + _select(new_asc_1) + _select(new_asc_2)
         else:
-            state_input = tf.zeros((4,))
-        if constants is not None:
-            if self._spike_gradient:
-                external_current = inputs[:,:self._n_neurons * self._n_receptors]
-                state_input = inputs[:, self._n_neurons * self._n_receptors:]
-            else:
-                external_current = inputs[:,:self._n_neurons * self._n_receptors]
-                state_input = inputs[:, self._n_neurons * self._n_receptors:]
-                state_input = tf.reshape(state_input, (batch_size, self._n_neurons, 4))
-        # external_current = inputs
-        z_buf, v, r, asc_1, asc_2, psc_rise, psc = state
-
-        shaped_z_buf = tf.reshape(z_buf, (-1, self.max_delay, self._n_neurons)) #shape (4, 50000)
-        prev_z = shaped_z_buf[:, 0] # previous spikes with shape (50000)
-
-        psc_rise = tf.reshape(psc_rise, (batch_size, self._n_neurons, self._n_receptors))
-        psc = tf.reshape(psc, (batch_size, self._n_neurons, self._n_receptors))
-
-        dampened_z_buf = z_buf * self._recurrent_dampening
-        rec_z_buf = tf.stop_gradient(z_buf - dampened_z_buf) + dampened_z_buf # here we use tf.stop_gradient to prevent the term (z_buf - dampened_z_buf) to be trained
+            return _select(new_asc_1) + _select(new_asc_2)
 
+    def _recurrent_current(self, rec_z_buf):
+        # Delayed recurrent input of every receptor, with shape (batch, n_receptors * n_neurons)
         sparse_w_rec = tf.sparse.SparseTensor(
             self.recurrent_indices, self.recurrent_weight_values, self.recurrent_dense_shape)
 
         i_rec = tf.sparse.sparse_dense_matmul(
             sparse_w_rec, tf.cast(rec_z_buf, tf.float32), adjoint_b=True)
         i_rec = tf.transpose(i_rec)
-        
-        rec_inputs = tf.cast(i_rec, self._compute_dtype)
-        rec_inputs = tf.reshape(
-            rec_inputs + external_current, (batch_size, self._n_neurons, self._n_receptors))
-        rec_inputs = rec_inputs * self._lr_scale
+        return tf.cast(i_rec, self._compute_dtype)
 
-        if constants is not None and not self._spike_gradient:
-            rec_inputs = rec_inputs + state_input * self._lr_scale
-        
-        new_psc_rise = psc_rise * self.syn_decay + rec_inputs * self.psc_initial
-        new_psc = psc * self.syn_decay + self._dt * self.syn_decay * psc_rise
+    def _neuron_update(self, rec_inputs, prev_z, v, r, asc_1, asc_2, psc_rise, psc, extra_current=None,
+                       params=None):
+        # rec_inputs has shape (batch, n_neurons, n_receptors) and is already scaled by lr_scale
+        if params is None:
+            params = self.neuron_params()
+        psc_rise = tf.reshape(psc_rise, (-1, self._n_neurons, self._n_receptors))
+        psc = tf.reshape(psc, (-1, self._n_neurons, self._n_receptors))
+
+        new_psc_rise = psc_rise * params['syn_decay'] + rec_inputs * params['psc_initial']
+        new_psc = psc * params['syn_decay'] + self._dt * params['syn_decay'] * psc_rise
 
         # New r is a variable that accounts for the refractory period in which
         # a neuron cannot spike
-        new_r = tf.nn.relu(r + prev_z * self.t_ref - self._dt) # =max(r + prev_z * self.t_ref - self._dt, 0)
+        new_r = tf.nn.relu(r + prev_z * params['t_ref'] - self._dt) # =max(r + prev_z * params['t_ref'] - self._dt, 0)
 
-        k = self.param_k_read()
-        asc_amps = self.asc_amps
+        k = params['k']
+        asc_amps = params['asc_amps']
         new_asc_1 = tf.exp(-self._dt * k[:, 0]) * asc_1 + prev_z * asc_amps[:, 0]
         new_asc_2 = tf.exp(-self._dt * k[:, 1]) * asc_2 + prev_z * asc_amps[:, 1]
 
-        if constants is not None and self._spike_gradient:
-            input_current = tf.reduce_sum(psc, -1) + state_input
+        if extra_current is not None:
+            input_current = tf.reduce_sum(psc, -1) + extra_current
         else:
             input_current = tf.reduce_sum(psc, -1)
         
-        decayed_v = self.decay * v
-        gathered_g = self.param_g * self.e_l
+        decayed_v = params['decay'] * v
+        gathered_g = params['param_g'] * params['e_l']
         c1 = input_current + asc_1 + asc_2 + gathered_g
         
         if self._hard_reset:
             # Here we keep the voltage at the reset value during the refractory period
-            new_v = tf.where(new_r > 0., self.v_reset, decayed_v + self.current_factor * c1)
+            new_v = tf.where(new_r > 0., params['v_reset'], decayed_v + params['current_factor'] * c1)
             # Here we make a hard reset and let the voltage freely evolve but we do not let the 
             # neuron spike during the refractory period
-            # new_v = tf.where(prev_z > 0., self.v_reset, decayed_v + self.current_factor * c1)
+            # new_v = tf.where(prev_z > 0., params['v_reset'], decayed_v + params['current_factor'] * c1)
         else:
-            reset_current = prev_z * (self.v_reset - self.v_th)
-            new_v = decayed_v + self.current_factor * c1 + reset_current
+            reset_current = prev_z * (params['v_reset'] - params['v_th'])
+            new_v = decayed_v + params['current_factor'] * c1 + reset_current
         
-        normalizer = self.v_th - self.e_l
-        v_sc = (new_v - self.v_th) / normalizer
+        normalizer = params['v_th'] - params['e_l']
+        v_sc = (new_v - params['v_th']) / normalizer
         new_z = spike_slayer(v_sc, 5., .6) # If v_sc is greater than 0 then there is a spike
         
         if False:
@@ -499,20 +668,94 @@ class BillehColumn(tf.keras.layers.Layer):
                     new_z = spike_function(v_sc, self._dampening_factor)
         
         new_z = tf.where(new_r > 0., tf.zeros_like(new_z), new_z)
-        new_psc = tf.reshape(new_psc, (batch_size, self._n_neurons * self._n_receptors))
-        new_psc_rise = tf.reshape(new_psc_rise, (batch_size, self._n_neurons * self._n_receptors))
-        
+        new_psc = tf.reshape(new_psc, (-1, self._n_neurons * self._n_receptors))
+        new_psc_rise = tf.reshape(new_psc_rise, (-1, self._n_neurons * self._n_receptors))
+
+        return new_z, new_v, new_r, new_asc_1, new_asc_2, new_psc_rise, new_psc, input_current
+
+    def call(self, inputs, state, constants=None):
+        batch_size = inputs.shape[0]
+        if batch_size is None:
+            batch_size = tf.shape(inputs)[0]
+        external_current = inputs
+        if self._spike_gradient:
+            state_input = tf.zeros((1,))
+        else:
+            state_input = tf.zeros((4,))
+        if constants is not None:
+            if self._spike_gradient:
+                external_current = inputs[:,:self._n_neurons * self._n_receptors]
+                state_input = inputs[:, self._n_neurons * self._n_receptors:]
+            else:
+                external_current = inputs[:,:self._n_neurons * self._n_receptors]
+                state_input = inputs[:, self._n_neurons * self._n_receptors:]
+                state_input = tf.reshape(state_input, (batch_size, self._n_neurons, 4))
+        # external_current = inputs
+        z_buf, v, r, asc_1, asc_2, psc_rise, psc = state[:7]
+
+        shaped_z_buf = tf.reshape(z_buf, (-1, self.max_delay, self._n_neurons)) #shape (4, 50000)
+        prev_z = shaped_z_buf[:, 0] # previous spikes with shape (50000)
+
+        dampened_z_buf = z_buf * self._recurrent_dampening
+        rec_z_buf = tf.stop_gradient(z_buf - dampened_z_buf) + dampened_z_buf # here we use tf.stop_gradient to prevent the term (z_buf - dampened_z_buf) to be trained
+
+        rec_inputs = self._recurrent_current(rec_z_buf)
+        rec_inputs = tf.reshape(
+            rec_inputs + external_current, (batch_size, self._n_neurons, self._n_receptors))
+        rec_inputs = rec_inputs * self._lr_scale
+
+        if constants is not None and not self._spike_gradient:
+            rec_inputs = rec_inputs + state_input * self._lr_scale
+
+        if constants is not None and self._spike_gradient:
+            extra_current = state_input
+        else:
+            extra_current = None
+
+        params = self.step_params()
+        new_z, new_v, new_r, new_asc_1, new_asc_2, new_psc_rise, new_psc, input_current = \
+            self._neuron_update(rec_inputs, prev_z, v, r, asc_1, asc_2, psc_rise, psc, extra_current, params)
+
         # new_z = tf.cast(new_z, tf.float16)
         
         new_shaped_z_buf = tf.concat((new_z[:, None], shaped_z_buf[:, :-1]), 1)
         new_z_buf = tf.reshape(new_shaped_z_buf, (-1, self._n_neurons * self.max_delay))
         
-        outputs = (new_z, new_v * self.voltage_scale + self.voltage_offset, input_current + new_asc_1 + new_asc_2)
+        if self._probes is None:
+            outputs = (new_z, new_v * params['voltage_scale'] + params['voltage_offset'],
+                       input_current + new_asc_1 + new_asc_2)
+        else:
+            outputs = (new_z,) + tuple(
+                self._probe_output(probe, new_v, input_current, new_asc_1, new_asc_2, params)
+                for probe in self._probes)
         new_state = (new_z_buf, new_v, new_r, new_asc_1, new_asc_2, new_psc_rise, new_psc)
+        if self._accumulate_statistics:
+            n_steps, spike_counts, voltage_loss = state[7:10]
+            # same penalty as VoltageRegularization, new_v being the normalized voltage
+            v_pos = tf.square(tf.nn.relu(new_v - 1.))
+            v_neg = tf.square(tf.nn.relu(-new_v + 1.))
+            new_state = new_state + (
+                n_steps + 1., spike_counts + new_z,
+                voltage_loss + tf.reduce_sum(tf.cast(v_pos + v_neg, voltage_loss.dtype), -1, keepdims=True))
 
         return outputs, new_state
 
 
+class ColumnRNN(tf.keras.layers.RNN):
+    # RNN of a BillehColumn that, with per_type_params, expands the neuron parameters (see
+    # BillehColumn.neuron_params) once per call, outside the loop over the steps, so that the steps
+    # read the expanded tensors instead of gathering the per type table again in every step. The
+    # expanded tensors live for the whole call
+    def call(self, inputs, *args, **kwargs):
+        if not self.cell._per_type_params:
+            return super().call(inputs, *args, **kwargs)
+        self.cell._expanded_params = self.cell.neuron_params()
+        try:
+            return super().call(inputs, *args, **kwargs)
+        finally:
+            self.cell._expanded_params = None
+
+
 def huber_quantile_loss(u, tau, kappa):
     branch_1 = tf.abs(tau - tf.cast(u <= 0, tf.float32)) / \
         (2 * kappa) * tf.square(u)
@@ -535,18 +778,55 @@ def compute_spike_rate_distribution_loss(_spikes, target_rate):
     return loss
 
 
+def compute_spike_rate_distribution_loss_histogram(_spikes, target_rate, n_bins=1000):
+    # Histogram alternative to the shuffle + sort of compute_spike_rate_distribution_loss. The rank of
+    # every neuron in the sorted rates is read from the cumulative histogram of the rates: a neuron
+    # in bin b draws a uniformly random rank among the ranks occupied by that bin. The draws of the
+    # neurons of a bin are independent, so two of them can take the same rank (and some ranks none),
+    # unlike the permutation given by the shuffled sort. The loss therefore only matches the sort-based
+    # one in expectation, up to the binning of the rates
+    _rate = tf.cast(tf.reduce_mean(_spikes, (0, 1)), tf.float32)
+    n_neurons = target_rate.shape[0]
+    stopped_rate = tf.stop_gradient(_rate)
+    value_range = tf.stack([0., tf.reduce_max(stopped_rate) + 1e-6])
+    counts = tf.histogram_fixed_width(stopped_rate, value_range, nbins=n_bins)
+    bin_ind = tf.histogram_fixed_width_bins(stopped_rate, value_range, nbins=n_bins)
+    first_rank = tf.gather(tf.cumsum(counts, exclusive=True), bin_ind)
+    bin_counts = tf.cast(tf.gather(counts, bin_ind), tf.float32)
+    rank = first_rank + tf.cast(tf.random.uniform((n_neurons,)) * bin_counts, tf.int32)
+    rank = tf.minimum(rank, n_neurons - 1)
+
+    u = tf.gather(target_rate, rank) - _rate
+    tau = (tf.cast(rank, tf.float32) + 1) / n_neurons
+    loss = huber_quantile_loss(u, tau, .002)
+
+    return loss
+
+
 class SpikeRateDistributionRegularization:
-    def __init__(self, target_rates, rate_cost=.5):
+    def __init__(self, target_rates, rate_cost=.5, mode='sort', n_bins=1000):
+        # mode='histogram' avoids sorting all the neuron rates in every training step
         self._rate_cost = rate_cost
         self._target_rates = target_rates
+        self._mode = mode
+        self._n_bins = n_bins
 
     def __call__(self, spikes):
-        reg_loss = compute_spike_rate_distribution_loss(
-            spikes, self._target_rates) * self._rate_cost
+        if self._mode == 'histogram':
+            reg_loss = compute_spike_rate_distribution_loss_histogram(
+                spikes, self._target_rates, n_bins=self._n_bins) * self._rate_cost
+        else:
+            reg_loss = compute_spike_rate_distribution_loss(
+                spikes, self._target_rates) * self._rate_cost
         reg_loss = tf.reduce_sum(reg_loss)
 
         return reg_loss
 
+    def from_statistics(self, statistics):
+        # Same loss from the spike counts accumulated in the cell state (see BillehColumn.accumulated_statistics)
+        rates = tf.cast(statistics['spike_counts'], tf.float32) / tf.cast(statistics['n_steps'], tf.float32)
+        return self(rates[None])
+
 
 class VoltageRegularization:
     def __init__(self, cell, voltage_cost=1e-5):
@@ -555,13 +835,18 @@ class VoltageRegularization:
 
     def __call__(self, voltages):
         voltage_32 = (tf.cast(voltages, tf.float32) -
-                      self._cell.voltage_offset) / self._cell.voltage_scale
+                      self._cell.per_neuron(self._cell.voltage_offset)) / self._cell.per_neuron(self._cell.voltage_scale)
         v_pos = tf.square(tf.nn.relu(voltage_32 - 1.))
         v_neg = tf.square(tf.nn.relu(-voltage_32 + 1.))
         voltage_loss = tf.reduce_mean(tf.reduce_sum(
             v_pos + v_neg, -1)) * self._voltage_cost
         return voltage_loss
 
+    def from_statistics(self, statistics):
+        # Same loss from the sums accumulated in the cell state (see BillehColumn.accumulated_statistics)
+        voltage_loss = tf.cast(statistics['voltage_loss'], tf.float32) / tf.cast(statistics['n_steps'], tf.float32)
+        return tf.reduce_mean(voltage_loss) * self._voltage_cost
+
 
 def create_model(network, input_population, bkg_weights, seq_len=100, n_input=10, n_output=2,
                  cue_duration=20, dtype=tf.float32, input_weight_scale=1., gauss_std=.5,
@@ -569,11 +854,14 @@ def create_model(network, input_population, bkg_weights, seq_len=100, n_input=10
                  train_input=True, neuron_output=False, recurrent_dampening_factor=.5,
                  use_state_input=False, return_state=False, return_sequences=False, down_sample=50,
                  add_metric=True, max_delay=5, batch_size=None, pseudo_gauss=False,
-                 hard_reset=True):
+                 hard_reset=True, per_type_params=False, probes=None, accumulate_statistics=False,
+                 preprocessed=None):
+    # preprocessed (see preprocess_column and column_cache.ColumnCache) is passed to BillehColumn, so that
+    # the network is not preprocessed again. network is then only read for the readout neurons
 
     # Create the input of the model
     x = tf.keras.layers.Input(shape=(seq_len, n_input,))
-    neurons = network['n_nodes']
+    neurons = network['n_nodes'] if preprocessed is None else preprocessed['n_neurons']
     state_input_holder = tf.keras.layers.Input(shape=(seq_len, neurons))
     state_input = tf.cast(tf.identity(state_input_holder), dtype) # tf.cast() changes the dtype
 
@@ -582,12 +870,18 @@ def create_model(network, input_population, bkg_weights, seq_len=100, n_input=10
     else:
         batch_size = batch_size
 
+    # The regularizers read the accumulated statistics, so unless probes are given the cell only
+    # emits the spikes and the full voltage and current sequences are never built
+    if accumulate_statistics and probes is None:
+        probes = []
+
     cell = BillehColumn(network, input_population, bkg_weights,
                         gauss_std=gauss_std, dampening_factor=dampening_factor,
                         input_weight_scale=input_weight_scale, lr_scale=lr_scale, spike_gradient=True,
                         recurrent_dampening_factor=recurrent_dampening_factor, max_delay=max_delay,
                         pseudo_gauss=pseudo_gauss, train_recurrent=train_recurrent, train_input=train_input,
-                        hard_reset=hard_reset)
+                        hard_reset=hard_reset, per_type_params=per_type_params, probes=probes,
+                        accumulate_statistics=accumulate_statistics, preprocessed=preprocessed)
 
     zero_state = cell.zero_state(batch_size, dtype)
     if use_state_input:
@@ -607,17 +901,19 @@ def create_model(network, input_population, bkg_weights, seq_len=100, n_input=10
     rnn_inputs = tf.cast(rnn_inputs, dtype)
     full_inputs = tf.concat((rnn_inputs, state_input), -1)
 
-    rnn = tf.keras.layers.RNN(
-        cell, return_sequences=True, return_state=return_state, name='rsnn')
+    # With accumulate_statistics the rsnn layer also returns its final state, and the model outputs the
+    # accumulated statistics (see BillehColumn.accumulated_statistics) after the prediction, ready for the
+    # from_statistics methods of the regularizers
+    rnn = ColumnRNN(
+        cell, return_sequences=True, return_state=return_state or accumulate_statistics, name='rsnn')
     out = rnn(full_inputs, initial_state=rnn_initial_state,
               constants=constants)
-    if return_state:
+    if return_state or accumulate_statistics:
         hidden = out[0]
         new_state = out[1:]
     else:
         hidden = out
     spikes = hidden[0]
-    voltage = hidden[1]
     rate = tf.cast(tf.reduce_mean(spikes, (1, 2)), tf.float32)
 
     if neuron_output:
@@ -645,12 +941,22 @@ def create_model(network, input_population, bkg_weights, seq_len=100, n_input=10
         mean_output = tf.reduce_mean(output[:, -cue_duration:], 1)
         mean_output = tf.nn.softmax(mean_output)
 
+    # The model outputs the prediction, then the sequence of every probe (decimated by probe.decimation)
+    # and last the accumulated statistics. Without probes nor statistics it only outputs the prediction
+    outputs = [mean_output]
+    if probes is not None:
+        outputs += [a[:, ::probe.decimation] for probe, a in zip(probes, hidden[1:])]
+    if accumulate_statistics:
+        outputs.append(cell.accumulated_statistics(new_state))
+    if len(outputs) == 1:
+        outputs = mean_output
+
     if use_state_input:
         many_input_model = tf.keras.Model(
-            inputs=[x, state_input_holder, initial_state_holder], outputs=mean_output)
+            inputs=[x, state_input_holder, initial_state_holder], outputs=outputs)
     else:
         many_input_model = tf.keras.Model(
-            inputs=[x, state_input_holder], outputs=mean_output)
+            inputs=[x, state_input_holder], outputs=outputs)
 
     if add_metric:
         many_input_model.add_metric(rate, name='rate')
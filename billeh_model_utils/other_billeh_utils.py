@@ -118,12 +118,28 @@ def voltage_spike_effect_correction(v, z, pre_spike_gap=2, post_spike_gap=3):
     return v
 
 ############################ DATA SAVING AND LOADING METHODS #########################
+def spikes_to_events(z):
+    # Dense spikes (n_simulations, simulation_length, n_neurons) -> (trial, time, neuron) events
+    trial, time_idx, neuron = np.nonzero(np.asarray(z))
+    return np.stack([trial, time_idx, neuron], -1).astype(np.int32)
+
+def events_to_spikes(events, shape):
+    # (trial, time, neuron) events -> dense uint8 spikes with the given shape
+    z = np.zeros(shape, np.uint8)
+    events = np.asarray(events)
+    z[events[:, 0], events[:, 1], events[:, 2]] = 1
+    return z
+
 class SaveSimDataHDF5:
-    def __init__(self, flags, keys, data_path, network, save_core_only=True, dtype=np.float16):
+    def __init__(self, flags, keys, data_path, network, save_core_only=True, dtype=np.float16,
+                 spike_format='dense'):
+        # With spike_format='events' the spikes are stored as (trial, time, neuron) events
+        # instead of dense (n_simulations, seq_len, n_neurons) uint8 arrays
         self.keys = keys
         self.data_path = data_path
         os.makedirs(self.data_path, exist_ok=True)
         self.dtype = dtype
+        self.spike_format = spike_format
         if save_core_only:
             self.core_mask = isolate_core_neurons(network, data_dir=flags.data_dir)
         else:
@@ -134,7 +150,12 @@ class SaveSimDataHDF5:
         with h5py.File(os.path.join(self.data_path, 'simulation_data.hdf5'), 'w') as f:
             g = f.create_group('Data')
             for key in self.keys:
-                if key=='z':
+                if key in ['z', 'z_lgn'] and self.spike_format == 'events':
+                    g.create_dataset(key, (0, 3), maxshape=(None, 3), dtype=np.int32,
+                                     chunks=True, compression='gzip', shuffle=True)
+                    g[key].attrs['format'] = 'events'
+                    g[key].attrs['shape'] = self.V1_data_shape if key == 'z' else self.LGN_data_shape
+                elif key=='z':
                     g.create_dataset(key, self.V1_data_shape, dtype=np.uint8, 
                                      chunks=True, compression='gzip', shuffle=True)
                 elif key=='z_lgn':
@@ -149,9 +170,20 @@ class SaveSimDataHDF5:
             g.attrs['Date'] = time.time()
                 
     def __call__(self, simulation_data, trial):
+        # The spikes can be given dense or as (trial, time, neuron) events of this trial
         with h5py.File(os.path.join(self.data_path, 'simulation_data.hdf5'), 'a') as f:
             for key, val in simulation_data.items():
+                if key in ['z', 'z_lgn'] and self.spike_format == 'events':
+                    events = np.array(val if np.ndim(val) == 2 else spikes_to_events(val), np.int32)
+                    events[:, 0] += trial
+                    dataset = f['Data'][key]
+                    n_old = dataset.shape[0]
+                    dataset.resize(n_old + len(events), axis=0)
+                    dataset[n_old:] = events
+                    continue
                 if key in ['z', 'z_lgn']:
+                    if np.ndim(val) == 2:
+                        val = events_to_spikes(val, (1,) + f['Data'][key].shape[1:])
                     val = np.array(val).astype(np.uint8)
                     # val = np.packbits(val)
                 else:
@@ -188,11 +220,12 @@ class SaveSimDataHDF5:
 
 class SaveSimData:
     def __init__(self, flags, keys, data_path, network, save_core_only=True, 
-                 compress_data=True, dtype=np.float16):
+                 compress_data=True, dtype=np.float16, spike_format='dense'):
         self.keys = keys
         self.data_path = data_path
         os.makedirs(self.data_path, exist_ok=True)
         self.dtype = dtype
+        self.spike_format = spike_format
         if save_core_only:
             self.core_mask = isolate_core_neurons(network, data_dir=flags.data_dir)
         else:
@@ -207,7 +240,13 @@ class SaveSimData:
                 
     def __call__(self, simulation_data, trial):
         for key, val in simulation_data.items():
-            if key in ['z', 'z_lgn']:
+            if key in ['z', 'z_lgn'] and self.spike_format == 'events':
+                # (trial, time, neuron) events, with trial relative to this file
+                val = np.array(val if np.ndim(val) == 2 else spikes_to_events(val), np.int32)
+            elif key in ['z', 'z_lgn']:
+                if np.ndim(val) == 2:
+                    data_shape = self.V1_data_shape if key == 'z' else self.LGN_data_shape
+                    val = events_to_spikes(val, (1,) + data_shape[1:])
                 val = np.array(val).astype(np.uint8)
                 # val = np.packbits(val)
             else:
@@ -239,7 +278,9 @@ class SaveSimData:
 def load_simulation_results(full_data_path, n_simulations=None, skip_first_simulation=False, 
                             variables=None, simulation_length=2500, n_neurons=230924, 
                             n_core_neurons=51978, n_input=17400,
-                            compress_data=True, dtype=np.float16):
+                            compress_data=True, dtype=np.float16, dense_spikes=True):
+    # Spikes saved as events are converted to dense arrays, unless dense_spikes=False, in which case
+    # data['z'] and data['z_lgn'] are (trial, time, neuron) events
     if compress_data:
         load_method = file_management.load_lzma
     else:
@@ -259,12 +300,23 @@ def load_simulation_results(full_data_path, n_simulations=None, skip_first_simul
     data = {key: (np.zeros((n_simulations, simulation_length, n_input), np.uint8) if key=='z_lgn' 
                   else np.zeros((n_simulations, simulation_length, n_neurons), np.uint8) if key=='z' 
                   else np.zeros((n_simulations, simulation_length, n_core_neurons), dtype))
-            for key in variables}
+            for key in variables if dense_spikes or key not in ['z', 'z_lgn']}
+    events = {key: [] for key in variables if not dense_spikes and key in ['z', 'z_lgn']}
 
     for i in range(first_simulation, last_simulation):
+        for key in events.keys():
+            key_trial_file = glob.glob(os.path.join(full_data_path, f'{key}_{i}.*'))[0]
+            data_array = load_method(key_trial_file)
+            if np.ndim(data_array) != 2:
+                data_array = spikes_to_events(data_array)
+            data_array = np.array(data_array, np.int32)
+            data_array[:, 0] += i - first_simulation
+            events[key].append(data_array)
         for key, value in data.items():
             key_trial_file = glob.glob(os.path.join(full_data_path, f'{key}_{i}.*'))[0]
             data_array = load_method(key_trial_file)
+            if key in ['z', 'z_lgn'] and np.ndim(data_array) == 2:
+                data_array = events_to_spikes(data_array, (1,) + value.shape[1:])
             # if key == 'z':
                 # unpacked_array = np.unpackbits(data_array)
                 # data_array = unpacked_array.reshape((1,simulation_length,n_neurons))
@@ -276,6 +328,9 @@ def load_simulation_results(full_data_path, n_simulations=None, skip_first_simul
             else:
                 data[key][(i-first_simulation):(i+1-first_simulation), :,:] = data_array.astype(np.float32)
             
+    for key, val in events.items():
+        data[key] = np.concatenate(val, 0) if len(val) > 0 else np.zeros((0, 3), np.int32)
+
     # if len(variables) == 1:
     #     data = data[key]
         
@@ -283,7 +338,7 @@ def load_simulation_results(full_data_path, n_simulations=None, skip_first_simul
 
 
 def load_simulation_results_hdf5(full_data_path, n_simulations=None, skip_first_simulation=False, 
-                                variables=None):
+                                variables=None, dense_spikes=True):
     # Prepare dictionary to store the simulation metadata
     flags_dict = {}
     with h5py.File(full_data_path, 'r') as f:
@@ -291,7 +346,10 @@ def load_simulation_results_hdf5(full_data_path, n_simulations=None, skip_first_
         flags_dict.update(dataset.attrs)
         # Get the simulation features
         if n_simulations is None:
-            n_simulations = dataset['z'].shape[0]
+            if dataset['z'].attrs.get('format') == 'events':
+                n_simulations = dataset['z'].attrs['shape'][0]
+            else:
+                n_simulations = dataset['z'].shape[0]
         first_simulation = 0
         last_simulation = n_simulations
         if skip_first_simulation:
@@ -305,7 +363,18 @@ def load_simulation_results_hdf5(full_data_path, n_simulations=None, skip_first_
         # Extract the simulation data
         data = {}
         for key in variables:
-            if key in ['z', 'z_lgn']:
+            if key in ['z', 'z_lgn'] and dataset[key].attrs.get('format') == 'events':
+                events = np.array(dataset[key])
+                events = events[np.logical_and(events[:, 0] >= first_simulation, events[:, 0] < last_simulation)]
+                events[:, 0] -= first_simulation
+                if dense_spikes:
+                    shape = (n_simulations,) + tuple(dataset[key].attrs['shape'][1:])
+                    data[key] = events_to_spikes(events, shape)
+                else:
+                    data[key] = events
+            elif key in ['z', 'z_lgn'] and not dense_spikes:
+                data[key] = spikes_to_events(dataset[key][first_simulation:last_simulation, :,:])
+            elif key in ['z', 'z_lgn']:
                data[key] = np.array(dataset[key][first_simulation:last_simulation, :,:]).astype(np.uint8) 
             else:
                 data[key] = np.array(dataset[key][first_simulation:last_simulation, :,:]).astype(np.float32)
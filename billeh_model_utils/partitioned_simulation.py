@@ -0,0 +1,228 @@
+import multiprocessing as mp
+import os
+import queue
+import time
+
+import numpy as np
+import tensorflow as tf
+
+import models
+
+
+def spatial_partition(network, n_shards):
+    # Recursive coordinate bisection: every split cuts the group of neurons along the axis
+    # (x, y or z) with the largest extent, so that each shard is a compact piece of the column
+    # and most of the synapses stay inside a shard
+    coords = np.stack([network['x'], network['y'], network['z']], -1)
+    shards = []
+
+    def _split(ids, n_parts):
+        if n_parts == 1:
+            shards.append(np.sort(ids))
+            return
+        extent = coords[ids].max(0) - coords[ids].min(0)
+        axis = np.argmax(extent)
+        sorted_ids = ids[np.argsort(coords[ids, axis], kind='stable')]
+        n_left = n_parts // 2
+        cut = int(np.round(len(ids) * n_left / n_parts))
+        _split(sorted_ids[:cut], n_left)
+        _split(sorted_ids[cut:], n_parts - n_left)
+
+    _split(np.arange(network['n_nodes']), n_shards)
+    return shards
+
+
+def build_shard(network, input_population, bkg_weights, shard_ids, tf_id_to_shard_id):
+    # Each shard keeps the state of its own neurons and all their incoming synapses. The targets
+    # are renumbered locally whereas the sources keep the (shard-major) global numbering,
+    # since every step the shard receives the spikes of the whole network
+    n_receptors = network['node_params']['tau_syn'].shape[1]
+    n_local = len(shard_ids)
+    n_total = network['n_nodes']
+    local_id = np.zeros(n_total, np.int64) - 1
+    local_id[shard_ids] = np.arange(n_local)
+
+    indices = network['synapses']['indices']
+    targets = local_id[indices[:, 0] // n_receptors]
+    sel = targets >= 0
+    shard_indices = np.stack([targets[sel] * n_receptors + indices[sel, 0] % n_receptors,
+                              tf_id_to_shard_id[indices[sel, 1]]], -1)
+
+    input_indices = input_population['indices']
+    input_targets = local_id[input_indices[:, 0] // n_receptors]
+    input_sel = input_targets >= 0
+    shard_input_indices = np.stack([input_targets[input_sel] * n_receptors + input_indices[input_sel, 0] % n_receptors,
+                                    input_indices[input_sel, 1]], -1)
+
+    shard_network = dict(
+        n_nodes=n_local,
+        n_edges=int(np.sum(sel)),
+        node_params=network['node_params'],
+        node_type_ids=network['node_type_ids'][shard_ids],
+        synapses=dict(indices=shard_indices, weights=network['synapses']['weights'][sel],
+                      delays=network['synapses']['delays'][sel],
+                      dense_shape=(n_receptors * n_local, n_total)))
+    shard_input_population = dict(
+        n_inputs=input_population['n_inputs'], indices=shard_input_indices,
+        weights=input_population['weights'][input_sel], delays=input_population['delays'][input_sel])
+    shard_bkg_weights = bkg_weights.reshape((n_total, -1))[shard_ids].reshape(-1)
+    return shard_network, shard_input_population, shard_bkg_weights
+
+
+class ShardColumn(models.BillehColumn):
+    def __init__(self, network, input_population, bkg_weights, offset, **kwargs):
+        # offset is the global id of the first neuron of the shard
+        if kwargs.get('probes') is not None or kwargs.get('accumulate_statistics', False):
+            raise ValueError('ShardColumn does not support probes nor accumulated statistics')
+        super().__init__(network, input_population, bkg_weights, **kwargs)
+        self._offset = offset
+        self.state_size = (self._n_sources * self.max_delay,) + tuple(self.state_size[1:])
+
+    def zero_state(self, batch_size, dtype=tf.float32):
+        _, v0, r0, asc_10, asc_20, psc_rise0, psc0 = super().zero_state(batch_size, dtype)
+        z0_buf = tf.zeros((batch_size, self._n_sources * self.max_delay), dtype)
+        return z0_buf, v0, r0, asc_10, asc_20, psc_rise0, psc0
+
+    def call(self, inputs, state, constants=None):
+        # inputs holds the external current of the shard followed by the spikes of the
+        # whole network in the previous step (gathered from all the shards)
+        external_current = inputs[:, :self._n_neurons * self._n_receptors]
+        global_z = inputs[:, self._n_neurons * self._n_receptors:]
+        z_buf, v, r, asc_1, asc_2, psc_rise, psc = state
+
+        # The delay buffer of a shard holds the spikes of all the network
+        shaped_z_buf = tf.reshape(z_buf, (-1, self.max_delay, self._n_sources))
+        shaped_z_buf = tf.concat((global_z[:, None], shaped_z_buf[:, :-1]), 1)
+        z_buf = tf.reshape(shaped_z_buf, (-1, self._n_sources * self.max_delay))
+        prev_z = global_z[:, self._offset:self._offset + self._n_neurons]
+
+        rec_inputs = self._recurrent_current(z_buf)
+        rec_inputs = tf.reshape(
+            rec_inputs + external_current, (-1, self._n_neurons, self._n_receptors))
+        rec_inputs = rec_inputs * self._lr_scale
+
+        params = self.step_params()
+        new_z, new_v, new_r, new_asc_1, new_asc_2, new_psc_rise, new_psc, _ = \
+            self._neuron_update(rec_inputs, prev_z, v, r, asc_1, asc_2, psc_rise, psc, params=params)
+
+        outputs = (new_z, new_v * params['voltage_scale'] + params['voltage_offset'])
+        new_state = (z_buf, new_v, new_r, new_asc_1, new_asc_2, new_psc_rise, new_psc)
+        return outputs, new_state
+
+
+def _shard_worker(shard_index, shard, offset, n_total, input_current, spike_exchange, barrier,
+                  cell_kwargs, n_threads, result_queue):
+    # input_current is the external current of the neurons of the shard, (batch, seq_len, n_local * n_receptors)
+    tf.config.threading.set_intra_op_parallelism_threads(n_threads)
+    tf.config.threading.set_inter_op_parallelism_threads(1)
+    shard_network, shard_input_population, shard_bkg_weights = shard
+    batch_size, seq_len, _ = input_current.shape
+    n_local = shard_network['n_nodes']
+
+    cell = ShardColumn(shard_network, shard_input_population, shard_bkg_weights, offset, **cell_kwargs)
+    input_current = tf.constant(input_current, tf.float32)
+    if cell._per_type_params:
+        # the parameters are fixed during the simulation, so they are expanded once instead of every step
+        cell._expanded_params = cell.neuron_params()
+
+    @tf.function
+    def step(external_current, global_z, state):
+        return cell(tf.concat((external_current, global_z), -1), state)
+
+    # Two buffers are alternated so that a single barrier per step is enough: nobody
+    # writes the buffer of step t + 2 before everybody has read the one of step t
+    exchange = np.frombuffer(spike_exchange, np.float32).reshape((2, batch_size, n_total))
+    state = cell.zero_state(batch_size)
+    global_z = tf.zeros((batch_size, n_total))
+    spikes = np.zeros((batch_size, seq_len, n_local), np.uint8)
+    barrier.wait()
+    t0 = time.time()
+    for t in range(seq_len):
+        (new_z, _), state = step(input_current[:, t], global_z, state)
+        new_z = new_z.numpy()
+        spikes[:, t] = new_z
+        exchange[t % 2, :, offset:offset + n_local] = new_z
+        barrier.wait()
+        global_z = tf.constant(exchange[t % 2])
+    elapsed = time.time() - t0
+    result_queue.put((shard_index, spikes, elapsed))
+
+
+def column_input_current(network, input_population, bkg_weights, lgn_input, **cell_kwargs):
+    # LGN and background current of the whole column, (batch, seq_len, n_receptors * n_neurons), with
+    # a single draw of the background noise per step shared by all the neurons, as in the unpartitioned model
+    cell = models.BillehColumn(network, input_population, bkg_weights, **cell_kwargs)
+    input_layer = models.SparseLayer(
+        cell.input_indices, cell.input_weight_values, cell.input_dense_shape, cell.bkg_weights)
+    return input_layer(tf.constant(lgn_input, tf.float32)).numpy()
+
+
+def run_partitioned_simulation(network, input_population, bkg_weights, lgn_input, n_shards,
+                               n_threads=None, seed=None, timeout=600., **cell_kwargs):
+    # Simulate the network split in n_shards processes that only exchange the spike vector each step.
+    # lgn_input has shape (batch, seq_len, n_inputs). The input current is computed once here (with the
+    # global seed set to seed, if given) and every shard receives the slice of its neurons. Returns the
+    # spikes (batch, seq_len, n_neurons) in the original neuron order and the wall time of the simulation loop.
+    # A shard that waits more than timeout seconds for the others breaks the barrier, and if any shard
+    # process dies the others are terminated and a RuntimeError is raised
+    if seed is not None:
+        tf.random.set_seed(seed)
+    input_current = column_input_current(network, input_population, bkg_weights, lgn_input, **cell_kwargs)
+    n_receptors = network['node_params']['tau_syn'].shape[1]
+    shards_ids = spatial_partition(network, n_shards)
+    # Neurons are renumbered so that every shard occupies a contiguous range of the spike vector
+    order = np.concatenate(shards_ids)
+    tf_id_to_shard_id = np.zeros(network['n_nodes'], np.int64)
+    tf_id_to_shard_id[order] = np.arange(network['n_nodes'])
+    offsets = np.cumsum([0] + [len(ids) for ids in shards_ids])
+    if n_threads is None:
+        n_threads = max(1, (os.cpu_count() or 1) // n_shards)
+
+    batch_size, seq_len, _ = lgn_input.shape
+    ctx = mp.get_context('spawn')
+    spike_exchange = ctx.RawArray('f', 2 * batch_size * network['n_nodes'])
+    barrier = ctx.Barrier(n_shards, timeout=timeout)
+    result_queue = ctx.Queue()
+    processes = []
+    for shard_index, shard_ids in enumerate(shards_ids):
+        shard = build_shard(network, input_population, bkg_weights, shard_ids, tf_id_to_shard_id)
+        shard_columns = (shard_ids[:, None] * n_receptors + np.arange(n_receptors)).reshape(-1)
+        p = ctx.Process(target=_shard_worker, args=(
+            shard_index, shard, offsets[shard_index], network['n_nodes'], input_current[..., shard_columns],
+            spike_exchange, barrier, cell_kwargs, n_threads, result_queue))
+        p.start()
+        processes.append(p)
+
+    results = []
+    while len(results) < n_shards:
+        try:
+            results.append(result_queue.get(timeout=1.))
+        except queue.Empty:
+            failed = [(i, p.exitcode) for i, p in enumerate(processes) if p.exitcode not in (None, 0)]
+            if len(failed) > 0:
+                for p in processes:
+                    p.terminate()
+                for p in processes:
+                    p.join()
+                raise RuntimeError(f'Shard processes failed (shard, exit code): {failed}')
+    for p in processes:
+        p.join()
+    results = sorted(results, key=lambda a: a[0])
+    shard_spikes = np.concatenate([a[1] for a in results], -1)
+    spikes = np.zeros_like(shard_spikes)
+    spikes[..., order] = shard_spikes
+    elapsed = max([a[2] for a in results])
+    return spikes, elapsed
+
+
+def benchmark_shard_scaling(network, input_population, bkg_weights, lgn_input, shard_counts=(1, 2, 4),
+                            **cell_kwargs):
+    # Throughput (simulated steps per second) of the partitioned simulation for each number of shards
+    seq_len = lgn_input.shape[1]
+    results = dict()
+    for n_shards in shard_counts:
+        _, elapsed = run_partitioned_simulation(
+            network, input_population, bkg_weights, lgn_input, n_shards, **cell_kwargs)
+        results[n_shards] = seq_len / elapsed
+        print(f'> {n_shards} shards: {results[n_shards]:.1f} steps/s')
+    return results
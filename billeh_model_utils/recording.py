@@ -0,0 +1,112 @@
+import os
+
+import h5py
+import numpy as np
+
+
+class MemorySink:
+    # Keeps the recorded pieces in host memory and concatenates them at the end
+    def __init__(self):
+        self._data = dict()
+        self._axes = dict()
+
+    def write(self, key, data, axis):
+        self._data.setdefault(key, []).append(np.asarray(data))
+        self._axes[key] = axis
+
+    def close(self):
+        pass
+
+    def result(self):
+        return {key: np.concatenate(val, self._axes[key]) for key, val in self._data.items()}
+
+
+class HDF5Sink:
+    # Appends every recorded piece to a resizable dataset, so nothing is kept in memory
+    def __init__(self, path, compression='gzip', dtypes=None):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.path = path
+        self._compression = compression
+        self._dtypes = dict() if dtypes is None else dtypes
+        self._file = h5py.File(path, 'w')
+
+    def write(self, key, data, axis):
+        data = np.asarray(data, self._dtypes.get(key, data.dtype))
+        if key not in self._file:
+            maxshape = list(data.shape)
+            maxshape[axis] = None
+            self._file.create_dataset(key, data=data, maxshape=tuple(maxshape), chunks=True,
+                                      compression=self._compression, shuffle=True)
+            return
+        dataset = self._file[key]
+        old_size = dataset.shape[axis]
+        dataset.resize(old_size + data.shape[axis], axis=axis)
+        sel = [slice(None)] * len(data.shape)
+        sel[axis] = slice(old_size, old_size + data.shape[axis])
+        dataset[tuple(sel)] = data
+
+    def close(self):
+        self._file.close()
+
+
+def to_spike_events(z, start=0):
+    # Dense spikes (batch, time, neurons) or events emitted by the simulation (n_spikes, 3)
+    # -> (trial, time, neuron) events, with time offset by start
+    z = np.asarray(z)
+    if z.ndim == 2:
+        events = z.astype(np.int32)
+        events[:, 1] += start
+        return events
+    trial, time, neuron = np.nonzero(z)
+    return np.stack([trial, time + start, neuron], -1).astype(np.int32)
+
+
+class StreamingRecorder:
+    # Called by ChunkedSimulator.run with the outputs (spikes, voltages, currents) of each time chunk:
+    #  - spikes are written as (trial, time, neuron) events
+    #  - voltages are kept every voltage_decimation steps (None does not record them),
+    #    for voltage_neuron_ids or for all the neurons
+    #  - currents are recorded for current_neuron_ids only (None does not record them)
+    def __init__(self, sink, spike_events=True, voltage_decimation=None, voltage_neuron_ids=None,
+                 current_neuron_ids=None):
+        self.sink = sink
+        self._spike_events = spike_events
+        self._voltage_decimation = voltage_decimation
+        self._voltage_neuron_ids = voltage_neuron_ids
+        self._current_neuron_ids = current_neuron_ids
+
+    def __call__(self, outputs, start):
+        z, v, currents = outputs[:3]
+        if self._spike_events:
+            self.sink.write('spike_events', to_spike_events(z.numpy(), start), axis=0)
+        if self._voltage_decimation is not None:
+            # first step of the chunk lying on the global decimation grid
+            first = (-start) % self._voltage_decimation
+            v = v.numpy()[:, first::self._voltage_decimation]
+            if self._voltage_neuron_ids is not None:
+                v = v[..., self._voltage_neuron_ids]
+            self.sink.write('v', v, axis=1)
+        if self._current_neuron_ids is not None:
+            self.sink.write('currents', currents.numpy()[..., self._current_neuron_ids], axis=1)
+
+    def close(self):
+        self.sink.close()
+
+
+class ProbeRecorder:
+    # Recorder for a cell built with probes (see models.Probe): the outputs are the spikes followed
+    # by one tensor per probe, which is decimated before being copied to the host
+    def __init__(self, sink, probes, spike_events=True):
+        self.sink = sink
+        self.probes = probes
+        self._spike_events = spike_events
+
+    def __call__(self, outputs, start):
+        if self._spike_events:
+            self.sink.write('spike_events', to_spike_events(outputs[0].numpy(), start), axis=0)
+        for probe, data in zip(self.probes, outputs[1:]):
+            first = (-start) % probe.decimation
+            self.sink.write(probe.name, data[:, first::probe.decimation].numpy(), axis=1)
+
+    def close(self):
+        self.sink.close()
@@ -0,0 +1,203 @@
+import numpy as np
+import tensorflow as tf
+
+import models
+
+
+def bucket_size(n, buckets=None):
+    # Smallest bucket that holds n. Without explicit buckets, n is rounded up to a power of two
+    if buckets is None:
+        return 1 << int(np.ceil(np.log2(max(n, 1))))
+    fitting = [a for a in sorted(buckets) if a >= n]
+    if len(fitting) == 0:
+        raise ValueError(f'No bucket holds a size of {n} (buckets: {buckets})')
+    return fitting[0]
+
+
+def pad_axis(x, size, axis=0):
+    # Zero-pad x along axis up to size
+    pad = [(0, 0)] * len(x.shape)
+    pad[axis] = (0, size - x.shape[axis])
+    return tf.pad(x, pad)
+
+
+class ChunkedSimulator:
+    # Runs a BillehColumn over a long stimulus in chunks of chunk_len steps, carrying the state
+    # between chunks, so that only (batch, chunk_len, n_neurons) outputs exist at any time.
+    # With spike_format='events' the spikes of every chunk leave the graph as (trial, time, neuron)
+    # events (time relative to the chunk) instead of a dense tensor.
+    # The chunk function has a fixed input signature with a dynamic time dimension, so a shorter last
+    # chunk does not retrace it. With batch_buckets (a list of sizes, or 'pow2') the batch is zero-padded
+    # to the next bucket, so that a new trace only happens for a new bucket. trace_count counts the traces.
+    # The background noise is drawn from the simulator's own noise_generator (seeded with noise_seed if
+    # given), which reset_noise reseeds without touching the global seed
+    cell_class = models.BillehColumn
+
+    def __init__(self, network, input_population, bkg_weights, chunk_len=100, dtype=tf.float32,
+                 spike_format='dense', batch_buckets=None, noise_seed=None, **cell_kwargs):
+        self.chunk_len = chunk_len
+        self.spike_format = spike_format
+        self.batch_buckets = batch_buckets
+        self.trace_count = 0
+        self._dtype = dtype
+        self._chunk_fns = dict()
+        if noise_seed is None:
+            self.noise_generator = tf.random.Generator.from_non_deterministic_state()
+        else:
+            self.noise_generator = tf.random.Generator.from_seed(noise_seed)
+        self.cell = self.cell_class(network, input_population, bkg_weights, **cell_kwargs)
+        # read from the cell, since a cell built from a cached column has no input_population
+        self._n_inputs = self.cell.input_dense_shape[1]
+        self.input_layer = models.SparseLayer(
+            self.cell.input_indices, self.cell.input_weight_values, self.cell.input_dense_shape,
+            self.cell.bkg_weights, dtype=dtype, noise_generator=self.noise_generator, name='input_layer')
+        self.background_layer = models.BackgroundNoiseLayer(
+            self.cell.bkg_weights, noise_generator=self.noise_generator, dtype=dtype, name='background_layer')
+        self.rnn = models.ColumnRNN(
+            self.cell, return_sequences=True, return_state=True, name='rsnn')
+
+    def zero_state(self, batch_size):
+        return self.cell.zero_state(batch_size, self._dtype)
+
+    def reset_noise(self, seed):
+        # the traced chunk functions read the generator state, so they keep working after the reset
+        self.noise_generator.reset_from_seed(seed)
+
+    def _input_phase(self, lgn_chunk):
+        return tf.cast(self.input_layer(lgn_chunk), self._dtype)
+
+    def _rnn_phase(self, rnn_inputs, state):
+        out = self.rnn(rnn_inputs, initial_state=list(state))
+        outputs = out[0]
+        if self.spike_format == 'events':
+            outputs = (tf.cast(tf.where(outputs[0] > 0), tf.int32),) + tuple(outputs[1:])
+        return outputs, tuple(out[1:])
+
+    def _run_chunk(self, lgn_chunk, state):
+        self.trace_count += 1
+        return self._rnn_phase(self._input_phase(lgn_chunk), state)
+
+    def _run_current_chunk(self, current_chunk, state):
+        # the LGN current is given, only the background noise is generated
+        self.trace_count += 1
+        rnn_inputs = tf.cast(current_chunk + self.background_layer(current_chunk), self._dtype)
+        return self._rnn_phase(rnn_inputs, state)
+
+    def _chunk_fn(self, batch_size, precomputed_current=False):
+        key = (batch_size, precomputed_current)
+        if key not in self._chunk_fns:
+            state_spec = tuple(tf.TensorSpec((batch_size, a), self._dtype) for a in self.cell.state_size)
+            if precomputed_current:
+                n_currents = self.cell.input_dense_shape[0]
+                self._chunk_fns[key] = tf.function(self._run_current_chunk, input_signature=[
+                    tf.TensorSpec((batch_size, None, n_currents), tf.float32), state_spec])
+            else:
+                self._chunk_fns[key] = tf.function(self._run_chunk, input_signature=[
+                    tf.TensorSpec((batch_size, None, self._n_inputs), tf.float32), state_spec])
+        return self._chunk_fns[key]
+
+    def _padded_batch_size(self, batch_size):
+        if self.batch_buckets is None:
+            return batch_size
+        return bucket_size(batch_size, None if self.batch_buckets == 'pow2' else self.batch_buckets)
+
+    def _trim_outputs(self, outputs, batch_size):
+        if self.spike_format == 'events':
+            events = outputs[0]
+            events = tf.boolean_mask(events, events[:, 0] < batch_size)
+            return (events,) + tuple(a[:batch_size] for a in outputs[1:])
+        return tuple(a[:batch_size] for a in outputs)
+
+    def run(self, lgn_input=None, state=None, recorder=None, profiler=None, input_current=None):
+        # lgn_input has shape (batch, seq_len, n_inputs). The outputs of every chunk are handed to
+        # recorder(outputs, start) and then dropped. Returns the state at the end of the stimulus.
+        # With a profiler (see instrumentation.ChunkProfiler) the input layer and the recurrent
+        # network run as separate functions so that every chunk can be timed phase by phase.
+        # Instead of lgn_input, input_current can give the precomputed LGN current of the stimulus
+        # (batch, seq_len, n_receptors * n_neurons), e.g. a memory-mapped array of input_cache, which is
+        # read chunk by chunk
+        precomputed_current = input_current is not None
+        if precomputed_current:
+            if profiler is not None:
+                raise ValueError('The profiler needs the LGN input')
+            lgn_input = input_current
+        batch_size, seq_len = lgn_input.shape[:2]
+        padded_batch_size = self._padded_batch_size(batch_size)
+        if state is None:
+            state = self.zero_state(padded_batch_size)
+        elif padded_batch_size > batch_size:
+            state = tuple(tf.concat((a, b[batch_size:]), 0)
+                          for a, b in zip(state, self.zero_state(padded_batch_size)))
+        state = tuple(state)
+        run_chunk = self._chunk_fn(padded_batch_size, precomputed_current)
+        for start in range(0, seq_len, self.chunk_len):
+            lgn_chunk = tf.constant(lgn_input[:, start:start + self.chunk_len], tf.float32)
+            lgn_chunk = pad_axis(lgn_chunk, padded_batch_size)
+            if profiler is None:
+                outputs, state = run_chunk(lgn_chunk, state)
+            else:
+                outputs, state = profiler.profile_chunk(self, lgn_chunk, state, start, batch_size)
+            if recorder is not None:
+                recorder(self._trim_outputs(outputs, batch_size), start)
+        return tuple(a[:batch_size] for a in state)
+
+
+class SimulationSession:
+    # Drives n_sessions independent simulations (one per batch row) online, e.g. with a stimulus
+    # generated in response to the network output. The state lives in variables and every call to
+    # advance moves it forward by as many steps as the given LGN input has. The step function has a
+    # fixed input signature (the number of steps is dynamic), so it is traced only once (see trace_count)
+    def __init__(self, network, input_population, bkg_weights, n_sessions=1, dtype=tf.float32,
+                 **cell_kwargs):
+        self.n_sessions = n_sessions
+        self.trace_count = 0
+        self._dtype = dtype
+        self.cell = models.BillehColumn(network, input_population, bkg_weights, **cell_kwargs)
+        self.input_layer = models.SparseLayer(
+            self.cell.input_indices, self.cell.input_weight_values, self.cell.input_dense_shape,
+            self.cell.bkg_weights, dtype=dtype, name='input_layer')
+        self.rnn = models.ColumnRNN(
+            self.cell, return_sequences=True, return_state=True, name='rsnn')
+        self.state = [tf.Variable(a, trainable=False, name=f'session_state_{i}')
+                      for i, a in enumerate(self.cell.zero_state(n_sessions, dtype))]
+
+        n_inputs = self.cell.input_dense_shape[1]
+        self._advance = tf.function(self._advance_steps, input_signature=[
+            tf.TensorSpec((n_sessions, None, n_inputs), tf.float32)])
+        self._reset = tf.function(self._reset_sessions, input_signature=[
+            tf.TensorSpec((n_sessions,), tf.bool)])
+
+    def _advance_steps(self, lgn_input):
+        self.trace_count += 1
+        rnn_inputs = tf.cast(self.input_layer(lgn_input), self._dtype)
+        out = self.rnn(rnn_inputs, initial_state=[a.read_value() for a in self.state])
+        for var, new_value in zip(self.state, out[1:]):
+            var.assign(new_value)
+        return out[0]
+
+    def _reset_sessions(self, mask):
+        for var, zero in zip(self.state, self.cell.zero_state(self.n_sessions, self._dtype)):
+            var.assign(tf.where(mask[:, None], zero, var))
+
+    def advance(self, lgn_input):
+        # lgn_input has shape (n_sessions, n_steps, n_inputs), or (n_sessions, n_inputs) for a single
+        # step. Returns the outputs of the cell, each with shape (n_sessions, n_steps, ...)
+        lgn_input = tf.convert_to_tensor(lgn_input, tf.float32)
+        if lgn_input.shape.rank == 2:
+            lgn_input = lgn_input[:, None]
+        return self._advance(lgn_input)
+
+    def reset(self, session_ids=None):
+        # Puts the given sessions (all of them if None) back at the initial state
+        mask = np.ones(self.n_sessions, bool)
+        if session_ids is not None:
+            mask = np.zeros(self.n_sessions, bool)
+            mask[session_ids] = True
+        self._reset(tf.constant(mask))
+
+    def get_state(self):
+        return tuple(a.read_value() for a in self.state)
+
+    def set_state(self, state):
+        for var, value in zip(self.state, state):
+            var.assign(tf.cast(value, var.dtype))
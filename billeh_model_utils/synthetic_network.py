@@ -0,0 +1,138 @@
+import numpy as np
+
+from load_sparse import rheobase, sort_indices
+
+# Parameters of a typical GLIF3 node type of the Billeh model, the synthetic node types are spread around them
+_BASE_NODE_PARAMS = dict(V_th=-34.78, g=4.33, E_L=-71.32, k=[0.003, 0.03], C_m=61.78, t_ref=2.2,
+                         asc_amps=[-6.62, -68.56])
+_BASE_TAU_SYN = [5.5, 8.5, 2.8, 5.8]
+_LAYERS = ['1', '23', '4', '5', '6']
+# depth (y) range of every layer of the column
+_LAYER_DEPTHS = dict([('1', (-100, 0)), ('23', (-310, -100)), ('4', (-430, -310)), ('5', (-650, -430)),
+                      ('6', (-850, -650))])
+
+
+def _sample_pairs(rd, n_targets, n_sources, p, exclude_self=False):
+    # Random (target, source) pairs, each pair being present with probability ~p. Drawing codes of the
+    # pairs avoids the dense (n_targets, n_sources) mask that does not fit in memory for large networks
+    n_pairs = rd.binomial(n_targets * n_sources, p)
+    codes = np.unique(rd.randint(0, n_targets * n_sources, size=n_pairs, dtype=np.int64))
+    targets, sources = codes // n_sources, codes % n_sources
+    if exclude_self:
+        sel = targets != sources
+        targets, sources = targets[sel], sources[sel]
+    return targets, sources
+
+
+def _poisson_spikes(rd, rate, duration, n_units, dt=1.):
+    # spike counts per dt bin (ms), rate in Hz (scalar or one value per unit)
+    rate = np.broadcast_to(np.asarray(rate, np.float64), (n_units,))
+    return rd.poisson(rate[None] * dt / 1000., size=(int(duration / dt), n_units)).astype(np.float64)
+
+
+def make_synthetic_billeh(n_neurons=1000, n_input=17400, n_node_types=20, n_receptors=4,
+                          connection_probability=.05, input_probability=.01, delay_range=(1., 5.),
+                          param_spread=.1, excitatory_fraction=.8, weight_scale=5., inhibitory_scale=4.,
+                          input_weight_scale=10., bkg_weight_scale=5., lgn_rate=20., bkg_rate=250.,
+                          duration=1000, radius=400., n_output=2, neurons_per_output=16, seed=3000):
+    # Random network with exactly the schema of load_sparse.load_billeh, to test and benchmark the model
+    # without the GLIF_network files. Returns input_population, network, bkg, bkg_weights.
+    #  - node types: the first excitatory_fraction of them are excitatory, each type lives in one layer
+    #    and its parameters are the typical GLIF3 ones times a log-normal factor of std param_spread
+    #  - synapses: every (target, source) pair is connected with connection_probability; the receptor is
+    #    0 for excitatory sources and 1, ..., n_receptors - 1 (one per inhibitory source type) otherwise.
+    #    Every (source type, target type) class has a single delay, uniform in delay_range, as in Billeh
+    #  - inputs: every LGN unit targets a neuron with input_probability, spikes are Poisson at lgn_rate
+    #    (Hz, a scalar or one rate per unit) for duration ms; a single background unit fires at bkg_rate
+    rd = np.random.RandomState(seed=seed)
+
+    # node types
+    n_exc_types = int(np.round(excitatory_fraction * n_node_types))
+    type_is_excitatory = np.arange(n_node_types) < n_exc_types
+    type_layer = np.array([_LAYERS[i % len(_LAYERS)] for i in range(n_node_types)])
+
+    def _spread(value, shape):
+        return (np.array(value) * np.exp(param_spread * rd.randn(*shape))).astype(np.float32)
+
+    e_l = (_BASE_NODE_PARAMS['E_L'] + 5 * param_spread * rd.randn(n_node_types)).astype(np.float32)
+    node_params = dict(
+        V_th=e_l + _spread(_BASE_NODE_PARAMS['V_th'] - _BASE_NODE_PARAMS['E_L'], (n_node_types,)),
+        g=_spread(_BASE_NODE_PARAMS['g'], (n_node_types,)),
+        E_L=e_l,
+        k=_spread(_BASE_NODE_PARAMS['k'], (n_node_types, 2)),
+        C_m=_spread(_BASE_NODE_PARAMS['C_m'], (n_node_types,)),
+        V_reset=e_l.copy(),
+        tau_syn=_spread(np.resize(_BASE_TAU_SYN, n_receptors), (n_node_types, n_receptors)),
+        t_ref=_spread(_BASE_NODE_PARAMS['t_ref'], (n_node_types,)),
+        asc_amps=_spread(_BASE_NODE_PARAMS['asc_amps'], (n_node_types, 2)),
+    )
+    node_params['rheobase'] = rheobase(node_params).astype(np.float32)
+    # receptor of the synapses made by each type
+    type_receptor = np.zeros(n_node_types, np.int64)
+    n_inh_types = n_node_types - n_exc_types
+    if n_receptors > 1:
+        type_receptor[n_exc_types:] = 1 + np.arange(n_inh_types) % (n_receptors - 1)
+
+    # neurons, placed in a cylinder of the given radius with the depth of their layer
+    node_type_ids = rd.randint(0, n_node_types, size=n_neurons).astype(np.int64)
+    r = radius * np.sqrt(rd.rand(n_neurons))
+    phi = 2 * np.pi * rd.rand(n_neurons)
+    x = (r * np.cos(phi)).astype(np.float32)
+    z = (r * np.sin(phi)).astype(np.float32)
+    depth_range = np.array([_LAYER_DEPTHS[a] for a in type_layer[node_type_ids]])
+    y = rd.uniform(depth_range[:, 0], depth_range[:, 1]).astype(np.float32)
+
+    # recurrent synapses
+    targets, sources = _sample_pairs(rd, n_neurons, n_neurons, connection_probability, exclude_self=True)
+    source_types = node_type_ids[sources]
+    class_delays = np.round(rd.uniform(delay_range[0], delay_range[1], (n_node_types, n_node_types)), 1)
+    weights = rd.lognormal(0., 1., size=len(targets)) * weight_scale
+    weights = np.where(type_is_excitatory[source_types], weights, -inhibitory_scale * weights)
+    indices = np.stack([targets * n_receptors + type_receptor[source_types], sources], -1).astype(np.int64)
+    delays = class_delays[source_types, node_type_ids[targets]].astype(np.float32)
+    indices, weights, delays = sort_indices(indices, weights.astype(np.float32), delays)
+
+    network = dict(
+        x=x, y=y, z=z,
+        n_nodes=n_neurons,
+        n_edges=len(indices),
+        node_params=node_params,
+        node_type_ids=node_type_ids,
+        synapses=dict(indices=indices, weights=weights, delays=delays,
+                      dense_shape=(n_receptors * n_neurons, n_neurons)),
+        tf_id_to_bmtk_id=np.arange(n_neurons),
+        bmtk_id_to_tf_id=np.arange(n_neurons),
+    )
+    print(f'> Number of Neurons: {n_neurons}')
+    print(f'> Number of Synapses: {len(indices)}')
+
+    # readout neurons among the layer 5 excitatory ones
+    l5e_types_indices = np.where(type_is_excitatory & (type_layer == '5'))[0]
+    l5e_neuron_sel = np.isin(node_type_ids, l5e_types_indices)
+    network['l5e_types'] = l5e_types_indices
+    network['l5e_neuron_sel'] = l5e_neuron_sel
+    readout_candidates = np.where(l5e_neuron_sel)[0]
+    if len(readout_candidates) < n_output * neurons_per_output:
+        # too small a network, use any excitatory neuron
+        readout_candidates = np.where(type_is_excitatory[node_type_ids])[0]
+    readout_neurons = rd.choice(readout_candidates, size=n_output * neurons_per_output, replace=False)
+    network['readout_neuron_ids'] = readout_neurons.reshape((n_output, neurons_per_output))
+
+    # LGN input, excitatory on the first receptor
+    input_targets, input_sources = _sample_pairs(rd, n_neurons, n_input, input_probability)
+    input_indices = np.stack([input_targets * n_receptors, input_sources], -1).astype(np.int64)
+    input_weights = rd.lognormal(0., .5, size=len(input_indices)) * input_weight_scale
+    input_indices, input_weights, input_delays = sort_indices(
+        input_indices, input_weights, np.ones(len(input_indices)))
+    input_population = dict(n_inputs=n_input, indices=input_indices, weights=input_weights,
+                            delays=input_delays, spikes=_poisson_spikes(rd, lgn_rate, duration, n_input))
+
+    # single background unit projecting to every neuron, with one weight per node type
+    type_bkg_weights = _spread(bkg_weight_scale, (n_node_types,))
+    bkg_indices = np.stack([np.arange(n_neurons) * n_receptors, np.zeros(n_neurons)], -1).astype(np.int64)
+    bkg = dict(n_inputs=1, indices=bkg_indices, weights=type_bkg_weights[node_type_ids].astype(np.float64),
+               delays=np.ones(n_neurons), spikes=_poisson_spikes(rd, bkg_rate, duration, 1))
+    bkg_weights = np.zeros((n_neurons * n_receptors,), np.float32)
+    bkg_weights[bkg['indices'][:, 0]] = bkg['weights']
+
+    return input_population, network, bkg, bkg_weights
@@ -0,0 +1,29 @@
+import numpy as np
+import pytest
+
+tf = pytest.importorskip('tensorflow')
+
+import models
+import partitioned_simulation
+import synthetic_network
+
+
+def test_single_shard_reproduces_column():
+    seed = 3000
+    input_population, network, _, bkg_weights = synthetic_network.make_synthetic_billeh(
+        n_neurons=200, n_input=100, seed=seed)
+    lgn_input = input_population['spikes'][None, :50].astype(np.float32)
+
+    tf.random.set_seed(seed)
+    cell = models.BillehColumn(network, input_population, bkg_weights)
+    input_layer = models.SparseLayer(
+        cell.input_indices, cell.input_weight_values, cell.input_dense_shape, cell.bkg_weights)
+    input_current = input_layer(tf.constant(lgn_input))
+    rnn = tf.keras.layers.RNN(cell, return_sequences=True)
+    expected = rnn(input_current, initial_state=cell.zero_state(1))[0].numpy()
+
+    spikes, _ = partitioned_simulation.run_partitioned_simulation(
+        network, input_population, bkg_weights, lgn_input, n_shards=1, n_threads=1, seed=seed)
+
+    assert np.sum(expected) > 0
+    np.testing.assert_array_equal(spikes, expected.astype(np.uint8))
@@ -0,0 +1,47 @@
+import numpy as np
+import pytest
+
+tf = pytest.importorskip('tensorflow')
+
+import distributed_utils
+import models
+import simulation
+import synthetic_network
+
+
+def _synthetic_column(seed=3000):
+    input_population, network, _, bkg_weights = synthetic_network.make_synthetic_billeh(
+        n_neurons=100, n_input=50, seed=seed)
+    return network, input_population, bkg_weights
+
+
+def test_chunked_simulator_traces_once_per_bucket():
+    network, input_population, bkg_weights = _synthetic_column()
+    simulator = simulation.ChunkedSimulator(
+        network, input_population, bkg_weights, chunk_len=10, batch_buckets=[4], noise_seed=3000)
+    rd = np.random.RandomState(3000)
+    for batch_size, seq_len in [(3, 10), (4, 25), (2, 7)]:
+        lgn_input = (rd.uniform(size=(batch_size, seq_len, 50)) < .05).astype(np.float32)
+        simulator.run(lgn_input)
+    assert simulator.trace_count == 1
+
+
+def test_trainer_traces_once_per_bucket():
+    network, input_population, bkg_weights = _synthetic_column()
+    seq_len = 20
+    strategy = distributed_utils.get_strategy(n_devices=1)
+    trainer = distributed_utils.DistributedTrainer(
+        strategy,
+        lambda: models.create_model(network, input_population, bkg_weights, seq_len=seq_len, n_input=50,
+                                    add_metric=False),
+        lambda: tf.keras.optimizers.Adam(1e-3), tf.keras.losses.sparse_categorical_crossentropy,
+        global_batch_size=4, batch_buckets=[4])
+    rd = np.random.RandomState(3000)
+    for batch_size in [3, 4]:
+        lgn_input = (rd.uniform(size=(batch_size, seq_len, 50)) < .05).astype(np.float32)
+        state_input = np.zeros((batch_size, seq_len, 100), np.float32)
+        labels = np.zeros(batch_size, np.int32)
+        dataset = tf.data.Dataset.from_tensors(((lgn_input, state_input), labels)).repeat()
+        losses = trainer.train(dataset, 2)
+        assert np.all(np.isfinite(losses))
+    assert trainer.trace_count == 1
@@ -0,0 +1,120 @@
+import multiprocessing as mp
+import os
+import shutil
+import tempfile
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from concurrent.futures.process import BrokenProcessPool
+
+import tensorflow as tf
+
+import array_store
+
+
+def _pin_worker(worker_index, n_threads):
+    # Bind the worker to its own n_threads cores (Linux only) and size the TF thread pools to
+    # them, so that the workers do not oversubscribe the node
+    n_cpus = os.cpu_count() or 1
+    if hasattr(os, 'sched_setaffinity'):
+        cores = {(worker_index * n_threads + i) % n_cpus for i in range(n_threads)}
+        os.sched_setaffinity(0, cores)
+    tf.config.threading.set_intra_op_parallelism_threads(n_threads)
+    tf.config.threading.set_inter_op_parallelism_threads(1)
+
+
+_worker_context = None
+
+
+def _init_worker(directory, setup_fn, n_threads, worker_counter):
+    global _worker_context
+    with worker_counter.get_lock():
+        worker_index = worker_counter.value
+        worker_counter.value += 1
+    if n_threads is not None:
+        _pin_worker(worker_index, n_threads)
+    network_data = array_store.load_arrays(directory)
+    _worker_context = network_data if setup_fn is None else setup_fn(*network_data)
+
+
+def _run_trial(trial_fn, trial):
+    return trial_fn(_worker_context, trial)
+
+
+class TrialScheduler:
+    # Runs independent trials (e.g. the stimuli of a sweep) on a pool of local processes that share one
+    # copy of the network. The network is written once as memory-mapped files (see array_store.save_arrays)
+    # and every worker attaches to it and calls setup_fn(*network_data) once, typically to build the
+    # model or ChunkedSimulator it reuses for all its trials. Then trial_fn(context, trial) runs in the
+    # worker for each trial, where context is what setup_fn returned (the network data without setup_fn).
+    # setup_fn and trial_fn must be module level functions, since the workers are spawned.
+    # A trial that raises, or whose worker dies (e.g. killed when out of memory), is retried up to
+    # max_retries times before its error is raised
+    def __init__(self, network_data, n_workers=None, n_threads=None, directory=None, max_retries=2):
+        n_cpus = os.cpu_count() or 1
+        self.n_workers = n_workers or n_cpus
+        self.n_threads = n_threads if n_threads is not None else max(1, n_cpus // self.n_workers)
+        self.max_retries = max_retries
+        self._owns_directory = directory is None
+        self.directory = array_store.save_arrays(
+            network_data, directory or tempfile.mkdtemp(prefix='billeh_network_'))
+        self._ctx = mp.get_context('spawn')
+        self._executor = None
+        self._setup_fn = None
+
+    def _start(self, setup_fn):
+        self._shutdown()
+        worker_counter = self._ctx.Value('i', 0)
+        self._executor = ProcessPoolExecutor(
+            self.n_workers, mp_context=self._ctx, initializer=_init_worker,
+            initargs=(self.directory, setup_fn, self.n_threads, worker_counter))
+        self._setup_fn = setup_fn
+
+    def _shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=True, cancel_futures=True)
+            self._executor = None
+
+    def map(self, trial_fn, trials, setup_fn=None):
+        # Results of trial_fn for every trial, in the order of trials. The pool is kept between calls
+        # with the same setup_fn
+        trials = list(trials)
+        if self._executor is None or setup_fn is not self._setup_fn:
+            self._start(setup_fn)
+        results = [None] * len(trials)
+        attempts = [0] * len(trials)
+        pending = {self._executor.submit(_run_trial, trial_fn, trial): i for i, trial in enumerate(trials)}
+        while len(pending) > 0:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            retry = []
+            broken = False
+            for future in done:
+                index = pending.pop(future)
+                try:
+                    results[index] = future.result()
+                except Exception as e:
+                    broken = broken or isinstance(e, BrokenProcessPool)
+                    attempts[index] += 1
+                    if attempts[index] > self.max_retries:
+                        self._shutdown()
+                        raise
+                    print(f'> Trial {index} failed with {e!r}, retry {attempts[index]} of {self.max_retries}')
+                    retry.append(index)
+            if broken:
+                # A dead worker breaks the whole pool, so the trials still in flight are lost with it
+                # and run again on a new pool
+                retry += list(pending.values())
+                pending = dict()
+                self._start(setup_fn)
+            for index in retry:
+                pending[self._executor.submit(_run_trial, trial_fn, trials[index])] = index
+        return results
+
+    def close(self):
+        self._shutdown()
+        if self._owns_directory:
+            shutil.rmtree(self.directory, ignore_errors=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -0,0 +1,84 @@
+import hashlib
+import os
+
+import numpy as np
+
+
+def cell_hash(cell):
+    # Fingerprint of everything that determines the dynamics of a BillehColumn: the neuron
+    # parameters, the recurrent, input and background weights and the delay buffer length
+    h = hashlib.sha1()
+    h.update(f'{cell.max_delay}_{cell._n_neurons}_{cell._lr_scale}_{cell._hard_reset}'.encode())
+    for var in sorted(cell.variables, key=lambda a: a.name):
+        h.update(var.name.encode())
+        h.update(np.ascontiguousarray(var.numpy()).tobytes())
+    return h.hexdigest()
+
+
+def snapshot_key(cell, seed, burn_in_steps, **config):
+    # config holds any other setting of the burn-in that is not part of the cell (e.g. the
+    # background rate of an experiment), it is appended to the key in sorted order
+    key = f'{cell_hash(cell)[:16]}_s{seed}_t{burn_in_steps}'
+    for name, value in sorted(config.items()):
+        key += f'_{name}{value}'
+    return key
+
+
+def burn_in(simulator, batch_size, n_steps, seed=None):
+    # Simulate n_steps of background drive only (the LGN is silent) starting from the zero state,
+    # so that every trial of the batch settles in a different steady state. The seed only resets the
+    # noise generator of the simulator
+    if seed is not None:
+        simulator.reset_noise(seed)
+    lgn_input = np.zeros((batch_size, n_steps, simulator.cell.input_dense_shape[1]), np.float32)
+    return simulator.run(lgn_input)
+
+
+class StateLibrary:
+    # Directory of settled network states (one .npz per key, one state per trial), so that trials can
+    # start after the burn-in instead of from BillehColumn.zero_state
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, key):
+        return os.path.join(self.directory, f'warm_state_{key}.npz')
+
+    def __contains__(self, key):
+        return os.path.exists(self.path(key))
+
+    def keys(self):
+        return sorted(a[len('warm_state_'):-len('.npz')] for a in os.listdir(self.directory)
+                      if a.startswith('warm_state_') and a.endswith('.npz'))
+
+    def save(self, key, state):
+        state = {f'state_{i}': np.asarray(a) for i, a in enumerate(state)}
+        # written to a temporary file first so that an interrupted save never leaves a broken snapshot.
+        # Its name does not end in .npz, so it is never listed by keys (np.savez would append the
+        # extension to a path, hence the file object)
+        tmp_path = self.path(key) + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            np.savez(f, **state)
+        os.replace(tmp_path, self.path(key))
+
+    def load(self, key, batch_size=None, seed=None):
+        # Returns the state tuple. With batch_size, the trials of the snapshot are sampled (without
+        # replacement whenever the snapshot holds enough of them) to form a batch of that size
+        with np.load(self.path(key)) as data:
+            state = tuple(data[f'state_{i}'] for i in range(len(data.files)))
+        if batch_size is not None:
+            n_stored = state[0].shape[0]
+            rd = np.random.RandomState(seed)
+            sel = rd.choice(n_stored, batch_size, replace=batch_size > n_stored)
+            state = tuple(a[sel] for a in state)
+        return state
+
+    def get_or_create(self, simulator, batch_size, burn_in_steps, seed=0, n_stored=None, **config):
+        # Load the warm state of the simulator cell for this configuration, running and storing the
+        # burn-in (of n_stored trials, batch_size by default) the first time it is requested
+        key = snapshot_key(simulator.cell, seed, burn_in_steps, **config)
+        if key not in self:
+            state = burn_in(simulator, n_stored or batch_size, burn_in_steps, seed)
+            self.save(key, state)
+            print(f'> Stored warm state {key}')
+        return self.load(key, batch_size, seed)